@@ -1,12 +1,20 @@
 import os
 import sys
-import shutil
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.optimize import leastsq
-import pdfkit
 import datetime
 
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+from template import html
+from plate_plans import get_ods, get_samples, read_ignore_file, get_reads, combine_reads, ods_from_values
+from plate_plans import get_reads_xls, get_reads_text, find_reader_file
+from outputs import new_run_id, output_dir, atomic_write, atomic_savefig, atomic_pdf, atomic_copy
+from outliers import find_outliers, outlier_file_text
+from fit_cache import cache_key, save_analysis, load_analysis, cached_figure
+from assays import load_assays
+from spatial_qc import plate_spatial_html
+
 '''
 Credit to https://people.duke.edu/~ccc14/pcfb/analysis.html for the code to fit 
 the 4 parameter logistic regression for the standard curve
@@ -39,7 +47,7 @@ def get_conc(y, p):
     concentration = step2 * C
     return concentration
 
-def mean_cv(group):
+def mean_cv(ods, group):
     """returns mean and cv of a group of wells"""
     group_ods = np.asarray(list(ods[group].values()))
     group_mean = sum(group_ods) / len(group_ods)
@@ -47,93 +55,206 @@ def mean_cv(group):
     group_cv = group_sd / group_mean
     return [group_mean, group_cv]
 
-std_concs_dict = {"hero": [1000, 571.4285714, 326.5306122, 186.5889213, 106.6222407, 60.9269947,
-                           34.81542555, 19.89452888, 11.36830222, 6.496172697, 3.712098684, 2.121199248],
-                  "who-s": [922.74, 527.28, 301.3028571, 172.1730612, 98.38460641, 56.21977509,
-                             32.12558577, 18.35747758, 10.48998719, 5.994278394, 3.425301939, 1.957315394],
-                  "who-n": [976.32, 557.8971429, 318.7983673, 182.1704956, 104.0974261, 59.48424347, 33.99099627,
-                           19.42342644, 11.09910082, 6.342343327, 3.624196187, 2.07096925]}
-
-
+def exclude_wells(ods, badwells, std_concs):
+    """returns copies of ods and std_concs without the wells in badwells. A bad standard well takes
+    the OD of the other standard curve, a standard with both wells bad is dropped from the fit"""
+    groups = list(ods.keys())
+    wells = [well for group in groups for well in ods[group]]
+    well_groups = [group for group in groups for well in ods[group]]
+    values = np.asarray([ods[group][well] for group in groups for well in ods[group]], dtype=float)
+    well_index = dict(zip(wells, range(len(wells))))
+    excluded = np.fromiter((well in badwells for well in wells), dtype=bool, count=len(wells))
+
+    std1 = np.asarray([well_index[well] for well in std_curve1_cells])
+    std2 = np.asarray([well_index[well] for well in std_curve2_cells])
+    both_bad = excluded[std1] & excluded[std2]
+    only1_bad = excluded[std1] & ~both_bad
+    only2_bad = excluded[std2] & ~both_bad
+    values[std1[only1_bad]] = values[std2[only1_bad]]
+    values[std2[only2_bad]] = values[std1[only2_bad]]
+    excluded[std1] = both_bad
+    excluded[std2] = both_bad
+
+    kept_ods = {group: {} for group in groups}
+    for i in np.flatnonzero(~excluded):
+        kept_ods[well_groups[i]][wells[i]] = values[i].item()
+    kept_concs = np.asarray(std_concs)[~both_bad].tolist()
+    return kept_ods, kept_concs
+
+def get_options(args):
+    """returns optional --name=value arguments as a dictionary"""
+    options = {}
+    for arg in args:
+        if not arg.startswith("--") or "=" not in arg:
+            print("Options must be given as --name=value, got %s" % arg)
+            sys.exit(1)
+        name, value = arg[2:].split("=", 1)
+        options[name] = value
+    return options
+
+def run_output_dir(options):
+    """returns the output directory of the run given by the --run-id option"""
+    run_id = options.get("run-id")
+    if run_id == "auto":
+        run_id = new_run_id()
+    out_dir = output_dir(run_id)
+    if run_id is not None:
+        print("Run ID: %s, writing output to %s" % (run_id, out_dir))
+    return out_dir
+
+def get_antigen(antigen):
+    """returns the antigen key of an antigen key or alias (such as N-Spec and N-Sens for n and n2)"""
+    if antigen not in antigen_keys:
+        print("Unknown antigen %s, %s defines: %s" % (antigen, assay_file, ", ".join(antigen_keys.keys())))
+        sys.exit(1)
+    return antigen_keys[antigen]
+
+def get_std_curve(std_curve):
+    """returns the standard curve name if the assay file defines it"""
+    if std_curve not in std_concs_dict:
+        print("Unknown std-curve %s, %s defines: %s" % (std_curve, assay_file, ", ".join(std_concs_dict.keys())))
+        sys.exit(1)
+    return std_curve
+
+def get_method(conc_index):
+    """returns the pos-neg-method if it is conc or index"""
+    if conc_index not in ["conc", "index"]:
+        print("Unknown pos-neg-method %s, use conc or index" % conc_index)
+        sys.exit(1)
+    return conc_index
+
+def get_shared(shared):
+    """returns the upper-cased --shared option of the pooled fit if it only names 4PL parameters A, B, C and D"""
+    if any(name not in "ABCD" for name in shared.upper()):
+        print("Unknown --shared=%s, use any of the 4PL parameters A, B, C and D, for example --shared=BC" % shared)
+        sys.exit(1)
+    return shared.upper()
+
+def check_plate_args(args):
+    """checks the antigen include-pdf std-curve pos-neg-method [--options] arguments of a plate run,
+    so a worker stops before claiming plates it would fail"""
+    if len(args) < 4:
+        print("Plate runs need antigen include-pdf std-curve pos-neg-method, got: %s" % " ".join(args))
+        sys.exit(1)
+    get_antigen(args[0])
+    if args[1] not in ["yes", "no"]:
+        print("include-pdf must be yes or no, got %s" % args[1])
+        sys.exit(1)
+    get_std_curve(args[2])
+    get_method(args[3])
+    options = get_options(args[4:])
+    if options.get("auto-outliers", "flag") not in ["flag", "exclude"]:
+        print("--auto-outliers must be flag or exclude")
+        sys.exit(1)
+
+def plate_runs(args, antigen, std_curve):
+    """returns (plate_id, antigen key, std-curve) of batch plate arguments. plateID:antigen:std-curve runs
+    that plate with another antigen and/or standard curve than the batch, either can be left empty"""
+    plates = []
+    for arg in args:
+        fields = arg.split(":")
+        if len(fields) > 3:
+            print("Plates are given as plateID, plateID:antigen or plateID:antigen:std-curve, got %s" % arg)
+            sys.exit(1)
+        plate_id, plate_antigen, plate_std_curve = fields + [""] * (3 - len(fields))
+        plates.append((plate_id, get_antigen(plate_antigen) if plate_antigen else antigen,
+                       get_std_curve(plate_std_curve) if plate_std_curve else std_curve))
+    return plates
 
 std_curve1_cells = ["B23", "C23", "D23", "E23", "F23", "G23", "H23", "I23", "J23", "K23", "L23", "M23"]
 std_curve2_cells = ["B24", "C24", "D24", "E24", "F24", "G24", "H24", "I24", "J24", "K24", "L24", "M24"]
 
-antigens = {"s" : "Spike", "n" : "Nucleocapsid", "n2": "Nucleocapsid2"}
+index_stds = ["Std09", "Std10", "Std11"]
 
-cut_offs = {"s" : 0.175, "n" : 0.722, "n2": 0.1905}
+#standard curves and antigen cutoffs come from assays.json in the working directory if there is one
+assay_file = "assays.json"
+if not os.path.exists(assay_file):
+    assay_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assays.json")
+try:
+    std_concs_dict, antigens, cut_offs, index_cutoffs, antigen_keys = load_assays(assay_file, index_stds)
+except ValueError as error:
+    print(error)
+    sys.exit(1)
 
-if __name__ == "__main__":
-    sys.path.insert(1, './scripts')
-    from template import html
-    from plate_plans import get_ods, get_samples
-    plate_id = sys.argv[1]
-    antigen = sys.argv[2]
-    if antigen == "N-Spec":
-        antigen = "n"
-    if antigen == "N-Sens":
-        antigen = "n2"
-    include_pdf = sys.argv[3]
-    std_concs = std_concs_dict[sys.argv[4]]
-    conc_index = sys.argv[5]
 
+def read_plate(plate_id, options):
+    """returns raw ods and sample names/dilutions of a plate, combining reads if the options ask for it"""
     plateplan_file = plate_id + "-pplan.xlsx"
-    platereader_file = plate_id + "-preader.xlsx"
-    ignore_file = plate_id + "-ignore.csv"
-    ods = get_ods(platereader_file) #retutns python dictionary with ods from plate
+    platereader_file = find_reader_file(plate_id)
+    reference_sheet = options.get("reference-sheet")
+    average_reads = options.get("average-reads", "no") == "yes"
+    if platereader_file.endswith(".xlsx") and reference_sheet is None and not average_reads:
+        ods = get_ods(platereader_file) #retutns python dictionary with ods from plate
+    else:
+        #returns (read x well) array from all Photometric sheets or value blocks
+        if platereader_file.endswith(".xlsx"):
+            sheet_names, reads = get_reads(platereader_file)
+        elif platereader_file.endswith(".xls"):
+            sheet_names, reads = get_reads_xls(platereader_file)
+        else:
+            sheet_names, reads = get_reads_text(platereader_file)
+        if len(sheet_names) > 1:
+            print("Found reads: %s" % ", ".join(sheet_names))
+        try:
+            ods = ods_from_values(combine_reads(sheet_names, reads, reference_sheet, average_reads))
+        except ValueError as error:
+            print("Plate %s: %s" % (plate_id, error))
+            sys.exit(1)
     sample_dilution = get_samples(plateplan_file) #returns python dictionary with samples names and dilutions
 
     print("Found plateplan file: %s" % plateplan_file)
     print("Found plate reader file: %s" % platereader_file)
+    return ods, sample_dilution
+
+def input_files(plate_id):
+    """returns the input files of a plate that exist"""
+    files = [plate_id + "-pplan.xlsx", find_reader_file(plate_id), plate_id + "-ignore.csv"]
+    return [file for file in files if os.path.exists(file)]
+
+def analysis_settings(std_curve, options):
+    """returns the settings that change the fitted curve of a plate"""
+    settings = {"std_curve": std_curve, "std_concs": list(std_concs_dict[std_curve])}
+    for option in ["reference-sheet", "average-reads", "auto-outliers", "cv-max", "z-max"]:
+        settings[option] = options.get(option)
+    return settings
+
+def run_record(antigen, std_curve, conc_index, out_dir):
+    """returns the antigen, std-curve and pos-neg-method a plate was called with and the output directory of
+    the run, kept with its cached fit"""
+    return {"antigen": antigen, "std_curve": std_curve, "pos_neg_method": conc_index, "out_dir": out_dir}
+
+def get_ignore_wells(plate_id, ods, options, out_dir):
+    """returns the wells to exclude (from the ignore file and automatic outliers) and the flagged wells"""
+    ignore_file = plate_id + "-ignore.csv"
+    ignore_wells = {}
 
-    if ignore_file in os.listdir():
+    if os.path.exists(ignore_file):
         print("Found ignore file: %s" % ignore_file)
-
-    print("Antigen: %s" % antigens[antigen])
-
-    np.set_printoptions(suppress=True) #suppresses scientific display of numbers
-
-### remove bad wells using ignore file ###
-    badwells = []
-    badwells_group = []
-    bad_std = []
-
-    if ignore_file in os.listdir():
-        with open(ignore_file) as infile:
-            for line in infile:
-                badwell = line.split(",")[0]
-                group = line.split(",")[1].replace("\n", "")
-                badwells.append(badwell)
-                badwells_group.append(group)
-
-    #if not in standard curve will delete. If in standard curve will take other standard OD. If both standard bad
-    #add to list and delete below
-    for group in list(ods.keys()):
-        for well in list(ods[group].keys()):
-            if well in badwells:
-                if well not in std_curve1_cells and well not in std_curve2_cells:
-                    del ods[group][well]
-                else:
-                    if well in std_curve1_cells:
-                        alternate_well = well[0:2] + "4"
-                        if alternate_well in std_curve2_cells:
-                            bad_std.append(std_curve2_cells.index(alternate_well))
-                            del ods[group][well]
-                        else:
-                            ods[group][well] = ods["std_curve2"][alternate_well]
-                    if well in std_curve2_cells:
-                        alternate_well = well[0:2] + "3"
-                        if alternate_well in std_curve1_cells:
-                            del ods[group][well]
-                        else:
-                            ods[group][well] = ods["std_curve1"][alternate_well]
-
-    #delete bad std from from concentration list
-    for std in bad_std:
-        del std_concs[std]
-
-
-##calculate CV for samples before blank subtracting
+        ignore_wells = read_ignore_file(ignore_file) #returns python dictionary of bad wells and their group
+
+    #optionally find outlier wells from the replicates and add them to the ignored wells
+    flagged_wells = {}
+    auto_outliers = options.get("auto-outliers")
+    if auto_outliers is not None:
+        if auto_outliers not in ["flag", "exclude"]:
+            print("--auto-outliers must be flag or exclude")
+            sys.exit(1)
+        outliers = find_outliers(ods, std_curve1_cells, std_curve2_cells, ignore_wells,
+                                 auto_outliers == "exclude",
+                                 cv_max=float(options.get("cv-max", 0.2)),
+                                 z_max=float(options.get("z-max", 3.5)))
+        auto_ignore_file = os.path.join(out_dir, plate_id + "-auto-ignore.csv")
+        atomic_write(auto_ignore_file, outlier_file_text(outliers, " ".join(sys.argv[1:])))
+        print("Found %s outlier wells, written to %s" % (len(outliers), auto_ignore_file))
+        for well, group, rule, action in outliers:
+            if action == "exclude":
+                ignore_wells[well] = "%s auto %s" % (group, rule)
+            else:
+                flagged_wells[well] = "%s auto %s" % (group, rule)
+    return ignore_wells, flagged_wells
+
+def get_sample_cvs(ods):
+    """returns the cv of each sample, rounded to 2 decimal places"""
     sample_cv = {}
     for sample in ods.keys():
         if "sample" in sample:
@@ -141,20 +262,21 @@ if __name__ == "__main__":
             mean = sum(sample_ods)/len(sample_ods)
             sd = np.std(sample_ods)
             cv = sd/mean
-            sample_cv[sample] = round(cv, 2)
-
-
-### subtract mean of blanks from all wells ###
-    blk_mean = mean_cv("blk")[0]
-    blk_cv = mean_cv("blk")[1]
+            sample_cv[sample] = round(cv.item(), 2)
+    return sample_cv
 
+def subtract_blanks(ods):
+    """returns the mean and cv of the blanks and a copy of ods with the mean of the blanks subtracted"""
+    blk_mean, blk_cv = mean_cv(ods, "blk")
+    minblk_ods = {}
     for group in ods.keys():
+        minblk_ods[group] = {}
         for well in ods[group].keys():
-            minblk_od = ods[group][well] - blk_mean
-            ods[group][well] = minblk_od
+            minblk_ods[group][well] = (ods[group][well] - blk_mean).item()
+    return blk_mean.item(), blk_cv.item(), minblk_ods
 
-### Fit standard curve using 4 parameter logistic regression ###
-    print("Fitting standard curve")
+def fit_std_curve(ods, std_concs):
+    """fits the 4PL to the mean of the two standard curves. Returns x, y and the fitted parameters"""
     x = np.asarray(std_concs)
 
     std_curve1_ods = np.asarray(list(ods["std_curve1"].values()))
@@ -167,25 +289,23 @@ if __name__ == "__main__":
 
     # Fit equation using least squares optimization
     plsq = leastsq(residuals, p0, args=(y, x))
+    return x, y, plsq[0]
 
-    # Plot results
-    plt.plot(x, peval(x, plsq[0]))
-    plt.plot(x, std_curve1_ods, '.', color='orange')
-    plt.plot(x, std_curve2_ods, '.', color='orange')
+def plot_std_curve(ods, x, plsq):
+    """returns a figure of the fitted standard curve and the standards"""
+    fig = plt.figure()
+    plt.plot(x, peval(x, plsq))
+    plt.plot(x, list(ods["std_curve1"].values()), '.', color='orange')
+    plt.plot(x, list(ods["std_curve2"].values()), '.', color='orange')
 
     plt.xscale("log", basex=10)
     plt.title("Standard curve")
     plt.xlabel("Unit of standard")
     plt.ylabel("OD")
+    return fig
 
-    fig_name = plate_id + ".png"
-    fig_path = os.path.join("figs", fig_name)
-    fig_path_html = os.path.join("html_reports/figs", fig_name)
-
-    plt.savefig(fig_path)
-    plt.savefig(fig_path_html)
-
-### Calculate CV of each standard and check index QC
+def check_standards(ods):
+    """returns the standards with a CV >= 0.1, the index standards that failed and the index standard means"""
     std1_as_list = list(ods["std_curve1"].values())
     std2_as_list = list(ods["std_curve2"].values())
 
@@ -201,10 +321,9 @@ if __name__ == "__main__":
     bad_stds = {}
     for std in std_cvs.keys():
         if std_cvs[std] >= 0.1:
-            bad_stds[std] = round(std_cvs[std], 3)
+            bad_stds[std] = round(std_cvs[std].item(), 3)
 
     # check and if necessary exclude index standards
-    index_stds = ["Std09", "Std10", "Std11"]
     failed_index_stds = []
     for index_std in index_stds:
         if index_std in bad_stds.keys():
@@ -213,62 +332,93 @@ if __name__ == "__main__":
     std_means = {"Std09": (std1_as_list[8] + std2_as_list[8]) / 2,
                  "Std10": (std1_as_list[9] + std2_as_list[9]) / 2,
                  "Std11": (std1_as_list[10] + std2_as_list[10]) / 2}
+    return bad_stds, failed_index_stds, std_means
 
-### calculate output variables###
+def clean_plate(plate_id, std_curve, options, out_dir):
+    """reads a plate, removes bad wells, subtracts the blanks and checks the standards.
+    Returns everything needed to fit the curve and call the samples"""
+    ods, sample_dilution = read_plate(plate_id, options)
+    ignore_wells, flagged_wells = get_ignore_wells(plate_id, ods, options, out_dir)
 
-    print("Calculating concentrations/index")
+    np.set_printoptions(suppress=True) #suppresses scientific display of numbers
+
+### remove bad wells using ignore file ###
+    #if not in standard curve will delete. If in standard curve will take other standard OD. If both standard bad
+    #the standard is removed from the fit
+    ods, std_concs = exclude_wells(ods, ignore_wells, std_concs_dict[std_curve])
+
+##calculate CV for samples before blank subtracting
+    sample_cv = get_sample_cvs(ods)
+
+### subtract mean of blanks from all wells ###
+    blk_mean, blk_cv, ods = subtract_blanks(ods)
+
+### Calculate CV of each standard and check index QC
+    bad_stds, failed_index_stds, std_means = check_standards(ods)
+
+    analysis = {"plate_id": plate_id,
+                "std_curve": std_curve,
+                "ods": ods,
+                "sample_dilution": sample_dilution,
+                "sample_cv": sample_cv,
+                "blk_mean": blk_mean,
+                "blk_cv": blk_cv,
+                "std_concs": std_concs,
+                "bad_stds": bad_stds,
+                "failed_index_stds": failed_index_stds,
+                "std_means": std_means,
+                "ignore_wells": ignore_wells,
+                "flagged_wells": flagged_wells}
+    return analysis
+
+def analyse_plate(plate_id, std_curve, options, out_dir):
+    """cleans and fits a plate. Returns everything needed to call the samples and the curve figure"""
+    analysis = clean_plate(plate_id, std_curve, options, out_dir)
+
+### Fit standard curve using 4 parameter logistic regression ###
+    print("Fitting standard curve")
+    x, y, plsq = fit_std_curve(analysis["ods"], analysis["std_concs"])
+    fig = plot_std_curve(analysis["ods"], x, plsq)
+
+    analysis["y"] = y.tolist()
+    analysis["plsq"] = plsq.tolist()
+    return analysis, fig
+
+def classify_samples(analysis, antigen, conc_index):
+    """returns the mean od, concentration and Pos/Neg call of each sample"""
+    ods = analysis["ods"]
+    plsq = analysis["plsq"]
+    y = analysis["y"]
     sample_means = {}
     sample_concs = {}
     pos_neg = {}
 
-    if conc_index == "conc":
-        for sample in ods.keys():
-            if "sample" in sample:
-                sample_ods = np.asarray(list(ods[sample].values()))
-                mean = sum(sample_ods)/len(sample_ods)
-                sample_concs[sample] = round(get_conc(mean, plsq[0]), 6)
-                sd = np.std(sample_ods)
-                cv = sd/mean
+    for sample in ods.keys():
+        if "sample" in sample:
+            sample_ods = np.asarray(list(ods[sample].values()))
+            mean = sum(sample_ods)/len(sample_ods)
+            sample_concs[sample] = round(get_conc(mean, plsq), 6)
 
-                if mean < y[-1]:
-                    sample_concs[sample] = "BelowCurve"
-                elif mean > y[0]:
-                    sample_concs[sample] = "AboveCurve"
+            if mean < y[-1]:
+                sample_concs[sample] = "BelowCurve"
+            elif mean > y[0]:
+                sample_concs[sample] = "AboveCurve"
 
-                sample_means[sample] = round(mean, 3)
+            sample_means[sample] = round(mean, 3)
 
+            if conc_index == "conc":
                 if sample_means[sample].item() > cut_offs[antigen]:
                     pos_neg[sample] = "Pos"
                 else:
                     pos_neg[sample] = "Neg"
 
-    index_cutoffs = {"s" : {"Std09":0.643, "Std10":1.087, "Std11":1.707},
-                     "n" : {"Std09":0.825, "Std10":1.287, "Std11":2.049},
-                     "n2": {"Std09":0.340, "Std10":0.541, "Std11":0.873}
-                     }
-
-    if conc_index == "index":
-        for sample in ods.keys():
-            if "sample" in sample:
-                sample_ods = np.asarray(list(ods[sample].values()))
-                mean = sum(sample_ods)/len(sample_ods)
-                sample_concs[sample] = round(get_conc(mean, plsq[0]), 6)
-                sd = np.std(sample_ods)
-                cv = sd/mean
-
-                if mean < y[-1]:
-                    sample_concs[sample] = "BelowCurve"
-                elif mean > y[0]:
-                    sample_concs[sample] = "AboveCurve"
-
-                sample_means[sample] = round(mean, 3)
-
+            if conc_index == "index":
                 sample_indices = {}
                 index_posneg = {}
 
                 for index_std in index_stds:
-                    if index_std not in failed_index_stds:
-                        sample_index = mean/std_means[index_std]
+                    if index_std not in analysis["failed_index_stds"]:
+                        sample_index = mean/analysis["std_means"][index_std]
                         sample_indices[index_std] = sample_index
                         index_posneg[index_std] = sample_index > index_cutoffs[antigen][index_std]
 
@@ -282,280 +432,228 @@ if __name__ == "__main__":
                     pos_neg[sample] = "Pos"
                 else:
                     pos_neg[sample] = "Neg"
+    return sample_means, sample_concs, pos_neg
 
+def report_html(analysis, antigen, conc_index, fig_path, sample_means, sample_concs, pos_neg):
+    """returns the html plate report"""
+    ods = analysis["ods"]
+    bad_stds = analysis["bad_stds"]
+    ignore_wells = analysis["ignore_wells"]
+    flagged_wells = analysis["flagged_wells"]
 
 ### determine conditional output text ###
-
     if len(bad_stds) == 0:
         std_text = "all standards have a CV <0.1"
     else:
         std_text = "all standard CVs <0.1 except: %s" % str(bad_stds)
 
-    ignore_wells = dict(zip(badwells, badwells_group))
-
-    if len(badwells) == 0:
+    if len(ignore_wells) == 0:
         ignore_text = "No wells exlcuded"
     else:
         ignore_text = "excluded these wells: %s" % ignore_wells
 
+    if len(flagged_wells) > 0:
+        ignore_text = ignore_text + ", flagged but kept these wells: %s" % flagged_wells
+
+    spatial_table, spatial_text = plate_spatial_html(ods)
+
+    now = datetime.datetime.now()
+    date = "%s-%s-%s" % (now.day, now.strftime("%b"), now.year)
+
+    html_values = [analysis["plate_id"],
+                   date,
+                   antigens[antigen],
+                   analysis["std_curve"],
+                   conc_index,
+                   fig_path,
+                   str(cut_offs[antigen]),
+                   round(analysis["blk_mean"], 3),
+                   round(analysis["blk_cv"], 3),
+
+                   round(mean_cv(ods, "pos")[0], 3),
+                   round(mean_cv(ods, "pos")[1], 3),
+
+                   round(mean_cv(ods, "neg")[0], 3),
+                   round(mean_cv(ods, "neg")[1], 3),
+
+                   std_text,
+
+                   ignore_text,
+
+                   spatial_text,
+                   spatial_table]
+
+    for sample in ods.keys():
+        if "sample" in sample:
+            html_values += [analysis["sample_dilution"][sample].split("-")[0],
+                            sample_means[sample],
+                            analysis["sample_cv"][sample],
+                            sample_concs[sample],
+                            pos_neg[sample]]
+    return html % tuple(html_values)
+
+def results_csv(analysis, sample_means, sample_concs, pos_neg):
+    """returns the text of the csv file of results"""
+    sample_dilution = analysis["sample_dilution"]
+    sample_cv = analysis["sample_cv"]
+    csv_lines = ["sampleid, dilution, od, cv, abunits, posneg\n"]
+    for sample in analysis["ods"].keys():
+        if "sample" in sample:
+            if sample_dilution[sample].split("-")[0] != "EMPTY":
+                csv_lines.append(sample_dilution[sample].split("-")[0]
+                                 + ", " + sample_dilution[sample].split("-")[1]
+                                 + ", " + str(sample_means[sample])
+                                 + ", " + str(sample_cv[sample])
+                                 + ", " + str(sample_concs[sample])
+                                 + ", " + pos_neg[sample] + "\n")
+            else:
+                csv_lines.append(sample_dilution[sample]
+                                 + ", NA"
+                                 + ", " + str(sample_means[sample])
+                                 + ", " + str(sample_cv[sample])
+                                 + ", " + str(sample_concs[sample])
+                                 + ", " + pos_neg[sample] + "\n")
+    return "".join(csv_lines)
+
+def write_results(analysis, antigen, include_pdf, conc_index, out_dir):
+    """calls the samples of an analysed plate and writes the html, pdf and csv outputs"""
+    plate_id = analysis["plate_id"]
+
+### calculate output variables###
+    print("Calculating concentrations/index")
+    sample_means, sample_concs, pos_neg = classify_samples(analysis, antigen, conc_index)
+
     if conc_index == "index":
-        if len(failed_index_stds) >= 2:
+        if len(analysis["failed_index_stds"]) >= 2:
             print("Index positive/negative call failed as 2 or more CVs >10%")
-            quit()
+            sys.exit(1)
 
 ### Output to pdf file ###
     print("Generating html file")
-    now = datetime.datetime.now()
-    date = "%s-%s-%s" % (now.day, now.strftime("%b"), now.year)
+    fig_path = os.path.join("figs", plate_id + ".png")
+    html_page = report_html(analysis, antigen, conc_index, fig_path, sample_means, sample_concs, pos_neg)
 
-    html_page = html % (plate_id,
-                            date,
-                            antigens[antigen],
-                            sys.argv[4],
-                            sys.argv[5],
-                            fig_path,
-                            str(cut_offs[antigen]),
-                            round(blk_mean, 3),
-                            round(blk_cv, 3),
-
-                            round(mean_cv("pos")[0], 3),
-                            round(mean_cv("pos")[1], 3),
-
-                            round(mean_cv("neg")[0], 3),
-                            round(mean_cv("neg")[1], 3),
-
-                            std_text,
-
-                            ignore_text,
-
-                            sample_dilution["sample01"].split("-")[0],
-                                sample_means["sample01"],
-                                sample_cv["sample01"],
-                                sample_concs["sample01"],
-                                pos_neg["sample01"],
-
-                            sample_dilution["sample02"].split("-")[0],
-                                sample_means["sample02"],
-                                sample_cv["sample02"],
-                                sample_concs["sample02"],
-                                pos_neg["sample02"],
-
-                            sample_dilution["sample03"].split("-")[0],
-                                sample_means["sample03"],
-                                sample_cv["sample03"],
-                                sample_concs["sample03"],
-                                pos_neg["sample03"],
-
-                            sample_dilution["sample04"].split("-")[0],
-                                sample_means["sample04"],
-                                sample_cv["sample04"],
-                                sample_concs["sample04"],
-                                pos_neg["sample04"],
-
-                            sample_dilution["sample05"].split("-")[0],
-                                sample_means["sample05"],
-                                sample_cv["sample05"],
-                                sample_concs["sample05"],
-                                pos_neg["sample05"],
-
-                            sample_dilution["sample06"].split("-")[0],
-                                sample_means["sample06"],
-                                sample_cv["sample06"],
-                                sample_concs["sample06"],
-                                pos_neg["sample06"],
-
-                            sample_dilution["sample07"].split("-")[0],
-                                sample_means["sample07"],
-                                sample_cv["sample07"],
-                                sample_concs["sample07"],
-                                pos_neg["sample07"],
-
-                            sample_dilution["sample08"].split("-")[0],
-                                sample_means["sample08"],
-                                sample_cv["sample08"],
-                                sample_concs["sample08"],
-                                pos_neg["sample08"],
-
-                            sample_dilution["sample09"].split("-")[0],
-                                sample_means["sample09"],
-                                sample_cv["sample09"],
-                                sample_concs["sample09"],
-                                pos_neg["sample09"],
-
-                            sample_dilution["sample10"].split("-")[0],
-                                sample_means["sample10"],
-                                sample_cv["sample10"],
-                                sample_concs["sample10"],
-                                pos_neg["sample10"],
-
-                            sample_dilution["sample11"].split("-")[0],
-                                sample_means["sample11"],
-                                sample_cv["sample11"],
-                                sample_concs["sample11"],
-                                pos_neg["sample11"],
-
-                            sample_dilution["sample12"].split("-")[0],
-                                sample_means["sample12"],
-                                sample_cv["sample12"],
-                                sample_concs["sample12"],
-                                pos_neg["sample12"],
-
-                            sample_dilution["sample13"].split("-")[0],
-                                sample_means["sample13"],
-                                sample_cv["sample13"],
-                                sample_concs["sample13"],
-                                pos_neg["sample13"],
-
-                            sample_dilution["sample14"].split("-")[0],
-                                sample_means["sample14"],
-                                sample_cv["sample14"],
-                                sample_concs["sample14"],
-                                pos_neg["sample14"],
-
-                            sample_dilution["sample15"].split("-")[0],
-                                sample_means["sample15"],
-                                sample_cv["sample15"],
-                                sample_concs["sample15"],
-                                pos_neg["sample15"],
-
-                            sample_dilution["sample16"].split("-")[0],
-                                sample_means["sample16"],
-                                sample_cv["sample16"],
-                                sample_concs["sample16"],
-                                pos_neg["sample16"],
-
-                            sample_dilution["sample17"].split("-")[0],
-                                sample_means["sample17"],
-                                sample_cv["sample17"],
-                                sample_concs["sample17"],
-                                pos_neg["sample17"],
-
-                            sample_dilution["sample18"].split("-")[0],
-                                sample_means["sample18"],
-                                sample_cv["sample18"],
-                                sample_concs["sample18"],
-                                pos_neg["sample18"],
-
-                            sample_dilution["sample19"].split("-")[0],
-                                sample_means["sample19"],
-                                sample_cv["sample19"],
-                                sample_concs["sample19"],
-                                pos_neg["sample19"],
-
-
-                            sample_dilution["sample20"].split("-")[0],
-                                sample_means["sample20"],
-                                sample_cv["sample20"],
-                                sample_concs["sample20"],
-                                pos_neg["sample20"],
-
-                            sample_dilution["sample21"].split("-")[0],
-                                sample_means["sample21"],
-                                sample_cv["sample21"],
-                                sample_concs["sample21"],
-                                pos_neg["sample21"],
-
-                            sample_dilution["sample22"].split("-")[0],
-                                sample_means["sample22"],
-                                sample_cv["sample22"],
-                                sample_concs["sample22"],
-                                pos_neg["sample22"],
-
-                            sample_dilution["sample23"].split("-")[0],
-                                sample_means["sample23"],
-                                sample_cv["sample23"],
-                                sample_concs["sample23"],
-                                pos_neg["sample23"],
-
-                            sample_dilution["sample24"].split("-")[0],
-                                sample_means["sample24"],
-                                sample_cv["sample24"],
-                                sample_concs["sample24"],
-                                pos_neg["sample24"],
-
-                            sample_dilution["sample25"].split("-")[0],
-                                sample_means["sample25"],
-                                sample_cv["sample25"],
-                                sample_concs["sample25"],
-                                pos_neg["sample25"],
-
-                            sample_dilution["sample26"].split("-")[0],
-                                sample_means["sample26"],
-                                sample_cv["sample26"],
-                                sample_concs["sample26"],
-                                pos_neg["sample26"],
-
-                            sample_dilution["sample27"].split("-")[0],
-                                sample_means["sample27"],
-                                sample_cv["sample27"],
-                                sample_concs["sample27"],
-                                pos_neg["sample27"],
-
-                            sample_dilution["sample28"].split("-")[0],
-                                sample_means["sample28"],
-                                sample_cv["sample28"],
-                                sample_concs["sample28"],
-                                pos_neg["sample28"],
-
-                            sample_dilution["sample29"].split("-")[0],
-                                sample_means["sample29"],
-                                sample_cv["sample29"],
-                                sample_concs["sample29"],
-                                pos_neg["sample29"],
-
-                            sample_dilution["sample30"].split("-")[0],
-                                sample_means["sample30"],
-                                sample_cv["sample30"],
-                                sample_concs["sample30"],
-                                pos_neg["sample30"],
-
-                            sample_dilution["sample31"].split("-")[0],
-                                sample_means["sample31"],
-                                sample_cv["sample31"],
-                                sample_concs["sample31"],
-                                pos_neg["sample31"],
-
-                            sample_dilution["sample32"].split("-")[0],
-                                sample_means["sample32"],
-                                sample_cv["sample32"],
-                                sample_concs["sample32"],
-                                pos_neg["sample32"]
-                            )
-
-    html_file = plate_id + ".html"
-    pdf_file = plate_id + ".pdf"
-
-    with open(plate_id + ".html", 'w') as htmlfile:
-        htmlfile.write(html_page)
+    html_file = os.path.join(out_dir, "html_reports", plate_id + ".html")
+    pdf_file = os.path.join(out_dir, plate_id + ".pdf")
 
     if include_pdf == "yes":
         print("Converting html to pdf...")
-        pdfkit.from_file(html_file, pdf_file)
+        atomic_pdf(html_page, out_dir, pdf_file)
 
-    shutil.move(html_file, os.path.join("html_reports", html_file))
+    atomic_write(html_file, html_page)
 
 ### Output to csv ###
     print("Creating csv file")
-    csv_file = plate_id + ".csv"
-
-    with open(csv_file, "w") as csvfile:
-        csvfile.write("sampleid, dilution, od, cv, abunits, posneg\n")
-        for sample in ods.keys():
-            if "sample" in sample:
-                if sample_dilution[sample].split("-")[0] != "EMPTY":
-                    csvfile.write(sample_dilution[sample].split("-")[0]
-                                  + ", " + sample_dilution[sample].split("-")[1]
-                                  + ", " + str(sample_means[sample])
-                                  + ", " + str(sample_cv[sample])
-                                  + ", " + str(sample_concs[sample])
-                                  + ", " + pos_neg[sample] + "\n")
-                else:
-                    csvfile.write(sample_dilution[sample]
-                                  + ", NA"
-                                  + ", " + str(sample_means[sample])
-                                  + ", " + str(sample_cv[sample])
-                                  + ", " + str(sample_concs[sample])
-                                  + ", " + pos_neg[sample] + "\n")
+    csv_file = os.path.join(out_dir, plate_id + ".csv")
+    atomic_write(csv_file, results_csv(analysis, sample_means, sample_concs, pos_neg))
 
+if __name__ == "__main__":
+    if sys.argv[1] == "worker":
+        from work_queue import run_worker
+        check_plate_args(sys.argv[3:])
+        run_worker(sys.argv[2], os.path.abspath(__file__), sys.argv[3:])
+        sys.exit()
+
+    #batch commands take their plate IDs last and options anywhere
+    batch_args = [arg for arg in sys.argv[2:] if not arg.startswith("--")]
+    batch_options = get_options([arg for arg in sys.argv[2:] if arg.startswith("--")])
+
+    if sys.argv[1] == "batch":
+        from shared_plates import run_batch
+        run_batch(plate_runs(batch_args[4:], get_antigen(batch_args[0]), get_std_curve(batch_args[1])),
+                  get_method(batch_args[2]), int(batch_args[3]), batch_options, run_output_dir(batch_options))
+        sys.exit()
+
+    if sys.argv[1] == "pooled":
+        from pooled_fit import run_pooled
+        run_pooled(plate_runs(batch_args[3:], get_antigen(batch_args[0]), get_std_curve(batch_args[1])),
+                   get_method(batch_args[2]), get_shared(batch_options.get("shared", "B")), batch_options,
+                   run_output_dir(batch_options))
+        sys.exit()
+
+    if sys.argv[1] == "stream":
+        from stream_plates import plate_list, run_stream
+        plate_list_file = batch_options.get("plate-list")
+        antigen = get_antigen(batch_args[0])
+        std_curve = get_std_curve(batch_args[1])
+        #every plate ID is checked before the stream starts, so a malformed one cannot stop it partway through
+        for plate_arg in plate_list(plate_list_file) if plate_list_file else batch_args[3:]:
+            plate_runs([plate_arg], antigen, std_curve)
+        plate_args = plate_list(plate_list_file) if plate_list_file else batch_args[3:]
+        run_stream((plate_runs([plate_arg], antigen, std_curve)[0] for plate_arg in plate_args),
+                   get_method(batch_args[2]), batch_options, run_output_dir(batch_options),
+                   batch_options.get("reports") == "yes")
+        sys.exit()
+
+    if sys.argv[1] == "dashboard":
+        from dashboard import update_dashboard
+        update_dashboard(batch_args, run_output_dir(batch_options))
+        sys.exit()
+
+    if sys.argv[1] == "roc":
+        from cutoff_roc import run_roc
+        run_roc(batch_args[1], get_antigen(batch_args[0]), int(batch_options.get("candidates", 2000)),
+                run_output_dir(batch_options))
+        sys.exit()
+
+    if sys.argv[1] == "spatial":
+        from spatial_qc import run_spatial, max_bias
+        out_dir = run_output_dir(batch_options)
+        std_curve = get_std_curve(batch_args[0])
+        analyses = [clean_plate(plate_id, std_curve, batch_options, out_dir) for plate_id in batch_args[1:]]
+        run_spatial(analyses, float(batch_options.get("max-bias", max_bias)), out_dir)
+        sys.exit()
+
+    if sys.argv[1] == "reconcile":
+        from reconcile import run_reconcile
+        run_reconcile(batch_args, float(batch_options.get("dilution-step", 10)), run_output_dir(batch_options))
+        sys.exit()
+
+    if sys.argv[1] == "export":
+        from lims_export import run_export
+        if "lims-url" not in batch_options:
+            print("export needs the LIMS address, for example --lims-url=http://lims.example.org/results")
+            sys.exit(1)
+        run_export(batch_args, batch_options["lims-url"], int(batch_options.get("batch-rows", 500)),
+                   int(batch_options.get("connections", 4)))
+        sys.exit()
+
+    #reclassify recalls the samples of a plate from its cached curve fit
+    args = sys.argv[1:]
+    reclassify = args[0] == "reclassify"
+    if reclassify:
+        args = args[1:]
+
+    plate_id = args[0]
+    antigen = get_antigen(args[1])
+    include_pdf = args[2]
+    std_curve = get_std_curve(args[3])
+    conc_index = get_method(args[4])
+    options = get_options(args[5:])
+
+    print("Antigen: %s" % antigens[antigen])
+    out_dir = run_output_dir(options)
 
+    fig_name = plate_id + ".png"
+    fig_path = os.path.join(out_dir, "figs", fig_name)
+    fig_path_html = os.path.join(out_dir, "html_reports", "figs", fig_name)
+    key = cache_key(input_files(plate_id), analysis_settings(std_curve, options))
+
+    if reclassify:
+        analysis = load_analysis(plate_id, key)
+        if analysis is None:
+            print("No cached fit of plate %s for these input files and options, run it without reclassify first"
+                  % plate_id)
+            sys.exit(1)
+        print("Using cached fit of plate %s" % plate_id)
+        atomic_copy(cached_figure(plate_id, key), fig_path)
+        atomic_copy(cached_figure(plate_id, key), fig_path_html)
+        save_analysis(analysis, key, None, run_record(antigen, std_curve, conc_index, out_dir))
+    else:
+        analysis, fig = analyse_plate(plate_id, std_curve, options, out_dir)
+        atomic_savefig(fig, fig_path)
+        atomic_savefig(fig, fig_path_html)
+        plt.close(fig)
+        save_analysis(analysis, key, fig_path, run_record(antigen, std_curve, conc_index, out_dir))
 
+    write_results(analysis, antigen, include_pdf, conc_index, out_dir)
@@ -0,0 +1,93 @@
+import json
+from types import MappingProxyType
+
+'''
+Assay definitions. The standard curve concentrations and the antigens with
+their names, aliases and positive/negative cutoffs are read from a json
+assay file (assays.json next to elisa_dl.py by default). The file is checked
+once when it is loaded and compiled into read-only lookups, so a bad entry
+stops the run before any plate is read and nothing can change the cutoffs
+part way through a batch. New antigens or standard curves only need a new
+entry in the file.
+'''
+
+std_curve_length = 12
+
+
+def is_number(value):
+    """returns True for ints and floats (not bools)"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def check_assays(definitions, index_stds):
+    """returns a list of everything wrong with the assay definitions"""
+    errors = []
+    std_curves = definitions.get("std_curves")
+    antigens = definitions.get("antigens")
+    if not isinstance(std_curves, dict) or len(std_curves) == 0:
+        errors.append("std_curves must map standard curve names to %s concentrations" % std_curve_length)
+        std_curves = {}
+    if not isinstance(antigens, dict) or len(antigens) == 0:
+        errors.append("antigens must map antigen keys to their definitions")
+        antigens = {}
+
+    for std_curve, concs in std_curves.items():
+        if (not isinstance(concs, list) or len(concs) != std_curve_length
+                or not all(is_number(conc) and conc > 0 for conc in concs)):
+            errors.append("std curve %s must have %s positive concentrations" % (std_curve, std_curve_length))
+        elif any(high <= low for high, low in zip(concs, concs[1:])):
+            errors.append("std curve %s concentrations must decrease from Std01 to Std%s"
+                          % (std_curve, std_curve_length))
+
+    names = {}
+    for antigen, assay in antigens.items():
+        if not isinstance(assay, dict):
+            errors.append("antigen %s must be a dictionary" % antigen)
+            continue
+        unknown = set(assay.keys()) - {"name", "aliases", "cut_off", "index_cutoffs"}
+        if len(unknown) > 0:
+            errors.append("antigen %s has unknown fields: %s" % (antigen, ", ".join(sorted(unknown))))
+        if not isinstance(assay.get("name"), str):
+            errors.append("antigen %s needs a name" % antigen)
+        if not (is_number(assay.get("cut_off")) and assay["cut_off"] > 0):
+            errors.append("antigen %s needs a positive cut_off" % antigen)
+        index_cutoffs = assay.get("index_cutoffs")
+        if (not isinstance(index_cutoffs, dict) or sorted(index_cutoffs.keys()) != sorted(index_stds)
+                or not all(is_number(cutoff) and cutoff > 0 for cutoff in index_cutoffs.values())):
+            errors.append("antigen %s needs positive index_cutoffs for %s" % (antigen, ", ".join(index_stds)))
+        aliases = assay.get("aliases", [])
+        if not isinstance(aliases, list) or not all(isinstance(alias, str) for alias in aliases):
+            errors.append("antigen %s aliases must be a list of names" % antigen)
+            aliases = []
+        for name in [antigen] + aliases:
+            if name in names:
+                errors.append("%s is used by antigens %s and %s" % (name, names[name], antigen))
+            names[name] = antigen
+    return errors
+
+
+def load_assays(file, index_stds):
+    """reads, checks and compiles an assay file. Returns read-only std_concs_dict, antigens, cut_offs,
+    index_cutoffs and antigen_keys (every key and alias to its antigen key) lookups"""
+    with open(file) as infile:
+        definitions = json.load(infile)
+    errors = check_assays(definitions, index_stds)
+    if len(errors) > 0:
+        raise ValueError("Invalid assay file %s:\n%s" % (file, "\n".join(errors)))
+
+    std_concs_dict = {}
+    for std_curve, concs in definitions["std_curves"].items():
+        std_concs_dict[std_curve] = tuple(concs)
+    antigens = {}
+    cut_offs = {}
+    index_cutoffs = {}
+    antigen_keys = {}
+    for antigen, assay in definitions["antigens"].items():
+        antigens[antigen] = assay["name"]
+        cut_offs[antigen] = assay["cut_off"]
+        index_cutoffs[antigen] = MappingProxyType({index_std: assay["index_cutoffs"][index_std]
+                                                   for index_std in index_stds})
+        for name in [antigen] + assay.get("aliases", []):
+            antigen_keys[name] = antigen
+    return (MappingProxyType(std_concs_dict), MappingProxyType(antigens), MappingProxyType(cut_offs),
+            MappingProxyType(index_cutoffs), MappingProxyType(antigen_keys))
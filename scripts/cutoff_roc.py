@@ -0,0 +1,183 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from plate_plans import plate_row
+from shared_plates import sample_names, sample_idx
+from fit_cache import latest_analysis
+from outputs import atomic_write
+from elisa_dl import cut_offs, index_cutoffs, index_stds
+
+'''
+Cutoff sweep and ROC analysis against a reference set of samples with known
+results. The blank subtracted ODs and index standard means of each plate are
+taken from the fit cache (any run of a plate for the antigen caches them), so nothing is
+re-read or refitted. Every candidate cutoff is evaluated at once: the sample
+scores are sorted and the number of positive and negative samples above each
+cutoff comes from one searchsorted call, so thousands of cutoffs over
+thousands of samples take milliseconds.
+
+The index method calls a sample positive if at least 2 of its 3 index ratios
+(OD / mean OD of Std09, Std10, Std11, leaving out failed index standards) are
+above the antigen's index cutoffs. With the three cutoffs scaled together by
+a factor s, ratio > s x cutoff is ratio / cutoff > s, so the call is
+positive when the 2nd largest ratio / cutoff is above s. The sweep over s is
+then the same sorted search, and is also done for the 1 of 3 and 3 of 3
+rules for comparison. Plates with 2 or more failed index standards get no
+index call from the pipeline, so their samples are left out of the index
+sweep (they are still in the conc sweep).
+'''
+
+
+def read_reference(file):
+    """returns a list of (plate_id, sample_id, is_positive) from a reference csv file with plateid, sampleid
+    and result (Pos/Neg or 1/0) columns"""
+    reference = []
+    with open(file) as infile:
+        next(infile)
+        for line in infile:
+            fields = [field.strip() for field in line.split(",")]
+            if len(fields) >= 3:
+                reference.append((fields[0], fields[1], fields[2].lower() in ["pos", "positive", "1"]))
+    return reference
+
+
+def reference_scores(reference, antigen):
+    """returns the rounded mean OD, the index ratios over the antigen's index cutoffs (-inf for failed index
+    standards), whether the plate's index call can be made (fewer than 2 failed index standards) and the
+    labels of the reference samples found in the cache, and the samples not found"""
+    by_plate = {}
+    for plate_id, sample_id, is_positive in reference:
+        by_plate.setdefault(plate_id, []).append((sample_id, is_positive))
+
+    sample_means = []
+    std_means = []
+    valid = []
+    index_ok = []
+    labels = []
+    missing = []
+    cutoffs = np.asarray([index_cutoffs[antigen][index_std] for index_std in index_stds])
+    for plate_id, samples in by_plate.items():
+        analysis = latest_analysis(plate_id, {"antigen": antigen})
+        if analysis is None:
+            missing += [(plate_id, sample_id) for sample_id, is_positive in samples]
+            continue
+        means = np.nanmean(plate_row(analysis["ods"])[sample_idx], axis=1)
+        sample_num = {analysis["sample_dilution"][sample].split("-")[0]: num
+                      for num, sample in enumerate(sample_names)}
+        for sample_id, is_positive in samples:
+            if sample_id not in sample_num:
+                missing.append((plate_id, sample_id))
+                continue
+            sample_means.append(means[sample_num[sample_id]])
+            std_means.append([analysis["std_means"][index_std] for index_std in index_stds])
+            valid.append([index_std not in analysis["failed_index_stds"] for index_std in index_stds])
+            index_ok.append(len(analysis["failed_index_stds"]) < 2)
+            labels.append(is_positive)
+
+    sample_means = np.asarray(sample_means)
+    std_means = np.asarray(std_means).reshape(-1, len(index_stds))
+    valid = np.asarray(valid, dtype=bool).reshape(-1, len(index_stds))
+    ratios = np.where(valid, sample_means[:, None] / std_means / cutoffs, -np.inf)
+    return (np.round(sample_means, 3), ratios, np.asarray(index_ok, dtype=bool), np.asarray(labels, dtype=bool),
+            missing)
+
+
+def sweep(scores, labels, cutoffs):
+    """returns the sensitivity and specificity of calling scores > cutoff positive for every cutoff"""
+    positives = np.sort(scores[labels])
+    negatives = np.sort(scores[~labels])
+    true_positives = len(positives) - np.searchsorted(positives, cutoffs, side="right")
+    true_negatives = np.searchsorted(negatives, cutoffs, side="right")
+    return true_positives / max(len(positives), 1), true_negatives / max(len(negatives), 1)
+
+
+def auc(scores, labels):
+    """returns the area under the ROC curve of scores, the chance a positive sample scores above a negative
+    one (ties count half)"""
+    positives = scores[labels]
+    negatives = np.sort(scores[~labels])
+    below = np.searchsorted(negatives, positives, side="left")
+    ties = np.searchsorted(negatives, positives, side="right") - below
+    return (below + ties / 2).sum() / max(len(positives) * len(negatives), 1)
+
+
+def candidate_cutoffs(scores, current, n_candidates):
+    """returns n_candidates cutoffs spread over the finite scores, plus the current cutoff (only the current
+    cutoff if no score is finite, e.g. when every index standard failed)"""
+    finite = scores[np.isfinite(scores)]
+    if len(finite) == 0:
+        return np.asarray([current], dtype=float)
+    return np.unique(np.append(np.linspace(finite.min(), finite.max(), n_candidates), current))
+
+
+def roc_lines(cutoffs, sensitivity, specificity, extra=None):
+    """returns the lines of a ROC table, with extra columns after the cutoff if given"""
+    lines = []
+    for row, (cutoff, sens, spec) in enumerate(zip(cutoffs, sensitivity, specificity)):
+        values = ["%.6g" % cutoff] + (extra[row] if extra is not None else [])
+        lines.append(", ".join(values + ["%.4f" % sens, "%.4f" % spec, "%.4f" % (sens + spec - 1)]) + "\n")
+    return lines
+
+
+def run_roc(reference_file, antigen, n_candidates, out_dir):
+    """sweeps the conc cutoff and the index cutoffs of antigen over the reference set and writes roc-conc.csv,
+    roc-index.csv and a summary of the current and best (Youden) cutoffs to roc-summary.csv"""
+    reference = read_reference(reference_file)
+    sample_means, ratios, index_ok, labels, missing = reference_scores(reference, antigen)
+    if len(missing) > 0:
+        print("%s reference samples have no cached plate results and are left out, for example %s %s"
+              % (len(missing), missing[0][0], missing[0][1]))
+    if len(labels) == 0:
+        print("No reference samples found in the cache, run their plates first")
+        sys.exit(1)
+    print("Sweeping %s cutoffs over %s reference samples (%s positive)" % (n_candidates, len(labels), labels.sum()))
+
+    summary = ["method, cutoffs, value, Std09, Std10, Std11, sensitivity, specificity, youden, auc\n"]
+    conc_cutoffs = candidate_cutoffs(sample_means, cut_offs[antigen], n_candidates)
+    sens, spec = sweep(sample_means, labels, conc_cutoffs)
+    atomic_write(os.path.join(out_dir, "roc-conc.csv"),
+                 "cutoff, sensitivity, specificity, youden\n" + "".join(roc_lines(conc_cutoffs, sens, spec)))
+    conc_auc = auc(sample_means, labels)
+    current = np.flatnonzero(conc_cutoffs == cut_offs[antigen])[0]
+    best = np.argmax(sens + spec)
+    for name, row in [("current", current), ("best", best)]:
+        summary.append("conc, %s, %.6g, , , , %.4f, %.4f, %.4f, %.4f\n"
+                       % (name, conc_cutoffs[row], sens[row], spec[row], sens[row] + spec[row] - 1, conc_auc))
+
+    #the pipeline makes no index call on plates with 2 or more failed index standards, so neither does the sweep
+    if not index_ok.all():
+        print("%s reference samples are on plates whose index call failed (2 or more failed index standards) and "
+              "are left out of the index sweep" % (~index_ok).sum())
+    ratios = ratios[index_ok]
+    index_labels = labels[index_ok]
+    index_lines = ["rule, scale, Std09, Std10, Std11, sensitivity, specificity, youden\n"]
+    base_cutoffs = [index_cutoffs[antigen][index_std] for index_std in index_stds]
+    if not index_ok.any():
+        print("No reference sample is on a plate with an index call, the index sweep is skipped")
+    for n_above in [1, 2, 3] if index_ok.any() else []:
+        rule = "%s of 3" % n_above
+        #nth largest ratio / cutoff of each sample
+        scores = -np.sort(-ratios, axis=1)[:, n_above - 1]
+        scales = candidate_cutoffs(scores, 1.0, n_candidates)
+        if not np.any(np.isfinite(scores)):
+            print("No reference sample has %s index standards that passed QC, only the current %s cutoffs are "
+                  "tested" % (n_above, rule))
+        sens, spec = sweep(scores, index_labels, scales)
+        extra = [["%.4f" % (scale * cutoff) for cutoff in base_cutoffs] for scale in scales]
+        index_lines += [rule + ", " + line for line in roc_lines(scales, sens, spec, extra)]
+        index_auc = auc(scores, index_labels)
+        current = np.flatnonzero(scales == 1.0)[0]
+        best = np.argmax(sens + spec)
+        for name, row in [("current", current), ("best", best)]:
+            summary.append("index %s, %s, %.6g, %s, %.4f, %.4f, %.4f, %.4f\n"
+                           % (rule, name, scales[row], ", ".join(extra[row]), sens[row], spec[row],
+                              sens[row] + spec[row] - 1, index_auc))
+    atomic_write(os.path.join(out_dir, "roc-index.csv"), "".join(index_lines))
+
+    summary_file = os.path.join(out_dir, "roc-summary.csv")
+    atomic_write(summary_file, "".join(summary))
+    print("".join(summary), end="")
+    print("ROC tables written to %s, %s and %s" % (os.path.join(out_dir, "roc-conc.csv"),
+                                                   os.path.join(out_dir, "roc-index.csv"), summary_file))
@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import datetime
+from urllib.parse import quote
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import elisa_dl
+from template import dashboard_html
+from fit_cache import new_index_entries, plate_cache_files
+from outputs import atomic_write
+
+'''
+Batch dashboard. html_reports/dashboard.html is one page listing every plate
+with its QC (blanks, controls, bad standards, failed index standards) and the
+number of positive and negative samples, linking to each plate's report. It
+can be searched by plate ID, filtered by QC status and is paged in the
+browser. The page itself never changes: the plates are in
+dashboard-plates.js, one addPlate(...) line per plate, and an update only
+appends lines for the fits saved to the cache since the last update. These
+come from the cache index (one file per machine in cache/index/) after the
+position reached last time in each file, kept in
+dashboard-cache-offsets.json, so adding plates costs the same
+however many plates are already on it or in the cache. A plate that is run
+again gets a new line, which replaces its old one on the page. Each plate is
+shown with the antigen and pos-neg-method recorded with its fit and links to
+the report in the output directory of the run it was analysed in.
+
+QC is "fail" if the index call failed (2 or more failed index standards),
+"check" if any standard, the blanks or a control has a CV >= qc_cv_max or
+the positive control is not above the negative control, and "ok" otherwise.
+'''
+
+qc_cv_max = 0.1
+plates_header = ("var plates = {};\n"
+                 "var plateOrder = [];\n"
+                 "function addPlate(plate) {\n"
+                 "  if (!(plate.id in plates)) { plateOrder.push(plate.id); }\n"
+                 "  plates[plate.id] = plate;\n"
+                 "}\n")
+
+
+def plate_summary(analysis, analysed, report):
+    """returns the dashboard row of an analysed plate, called with the antigen and pos-neg-method it was run
+    with"""
+    antigen = analysis["run"]["antigen"]
+    conc_index = analysis["run"]["pos_neg_method"]
+    pos_mean, pos_cv = elisa_dl.mean_cv(analysis["ods"], "pos")
+    neg_mean, neg_cv = elisa_dl.mean_cv(analysis["ods"], "neg")
+    sample_means, sample_concs, pos_neg = elisa_dl.classify_samples(analysis, antigen, conc_index)
+    samples = [sample for sample in pos_neg if analysis["sample_dilution"][sample].split("-")[0] != "EMPTY"]
+
+    qc_notes = []
+    if len(analysis["bad_stds"]) > 0:
+        qc_notes.append("standard CV")
+    if analysis["blk_cv"] >= qc_cv_max:
+        qc_notes.append("blank CV")
+    if pos_cv >= qc_cv_max or neg_cv >= qc_cv_max:
+        qc_notes.append("control CV")
+    if pos_mean <= neg_mean:
+        qc_notes.append("pos control not above neg")
+    if conc_index == "index" and len(analysis["failed_index_stds"]) >= 2:
+        qc = "fail"
+        qc_notes.insert(0, "index call failed")
+    elif len(qc_notes) > 0:
+        qc = "check"
+    else:
+        qc = "ok"
+
+    return {"id": analysis["plate_id"],
+            "report": report,
+            "analysed": analysed,
+            "antigen": elisa_dl.antigens[antigen],
+            "method": conc_index,
+            "qc": qc,
+            "qc_notes": qc_notes,
+            "blk": "%.3f / %.3f" % (analysis["blk_mean"], analysis["blk_cv"]),
+            "pos": "%.3f / %.3f" % (pos_mean, pos_cv),
+            "neg": "%.3f / %.3f" % (neg_mean, neg_cv),
+            "bad_stds": " ".join("%s %s" % item for item in analysis["bad_stds"].items()),
+            "failed_index_stds": " ".join(analysis["failed_index_stds"]),
+            "n_pos": 0 if qc == "fail" else [pos_neg[sample] for sample in samples].count("Pos"),
+            "n_neg": 0 if qc == "fail" else [pos_neg[sample] for sample in samples].count("Neg"),
+            "above": [str(sample_concs[sample]) for sample in samples].count("AboveCurve"),
+            "below": [str(sample_concs[sample]) for sample in samples].count("BelowCurve")}
+
+
+def report_link(analysis, report_dir):
+    """returns the link from the dashboard in report_dir to the html report of an analysed plate, or None if
+    the plate has no report"""
+    report = os.path.join(analysis["run"]["out_dir"], "html_reports", analysis["plate_id"] + ".html")
+    if not os.path.exists(report):
+        return None
+    return quote(os.path.relpath(report, report_dir).replace(os.sep, "/"))
+
+
+def update_dashboard(plate_ids, out_dir):
+    """adds the fits cached since the last update (or the latest cached fit of each of plate_ids if given) to
+    the dashboard. Returns the number of plates added"""
+    report_dir = os.path.join(out_dir, "html_reports")
+    page_file = os.path.join(report_dir, "dashboard.html")
+    plates_file = os.path.join(report_dir, "dashboard-plates.js")
+    offsets_file = os.path.join(report_dir, "dashboard-cache-offsets.json")
+    if not os.path.exists(page_file):
+        atomic_write(page_file, dashboard_html)
+    if not os.path.exists(plates_file):
+        atomic_write(plates_file, plates_header)
+
+    if len(plate_ids) > 0:
+        cache_files = []
+        for plate_id in plate_ids:
+            plate_files = plate_cache_files(plate_id)
+            if len(plate_files) == 0:
+                print("Plate %s has no cached fit, run it first" % plate_id)
+            else:
+                cache_files.append(plate_files[0])
+        new_offsets = None
+    else:
+        offsets = {}
+        if os.path.exists(offsets_file):
+            with open(offsets_file) as infile:
+                offsets = json.load(infile)
+        cache_files, new_offsets, bad_lines = new_index_entries(offsets)
+        if len(bad_lines) > 0:
+            print("%s lines of the cache index do not name a cached fit and are skipped (re-run those plates to "
+                  "add them), for example %s" % (len(bad_lines), bad_lines[0]))
+
+    lines = []
+    no_run = 0
+    for cache_file in cache_files:
+        try:
+            with open(cache_file) as infile:
+                analysis = json.load(infile)
+        except (OSError, ValueError) as error:
+            print("Cached fit %s could not be read and is skipped: %s" % (cache_file, error))
+            continue
+        if "run" not in analysis:
+            no_run += 1
+            continue
+        analysed = datetime.datetime.fromtimestamp(os.path.getmtime(cache_file)).strftime("%Y-%m-%d %H:%M")
+        summary = plate_summary(analysis, analysed, report_link(analysis, report_dir))
+        lines.append("addPlate(%s);\n" % json.dumps(summary))
+
+    #plates go on the page before the offset is moved on, so an interrupted update repeats rather than loses them
+    with open(plates_file, "a") as outfile:
+        outfile.writelines(lines)
+    if new_offsets is not None:
+        atomic_write(offsets_file, json.dumps(new_offsets))
+    if no_run > 0:
+        print("%s cached fits do not record the antigen and pos-neg-method they were run with, run them again "
+              "to add them" % no_run)
+    print("Added %s plates to %s" % (len(lines), page_file))
+    return len(lines)
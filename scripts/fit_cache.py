@@ -0,0 +1,121 @@
+import os
+import re
+import glob
+import json
+import socket
+import hashlib
+from outputs import atomic_write, atomic_copy
+
+'''
+Cache of analysed plates so the samples can be called again (with the other
+pos-neg-method or after a change to the cutoffs) without re-reading the
+excel files, refitting the standard curve or redrawing the figure. Entries
+are keyed by a hash of the input files of the plate (plate plan, plate reader
+and ignore file) and the settings that change the fit (standard curve, reads
+and automatic outlier options), so any change to those is a cache miss.
+The antigen and pos-neg-method do not change the fit, so they are not part of
+the key, but each entry records the antigen, std-curve and pos-neg-method the
+plate was last called with and the output directory of the run. Lookups by
+plate ID alone (the ROC sweep) match on these, so they never pick up a plate
+run for another assay. Every save also appends the entry's file name to an
+index, so the dashboard can read only the entries saved since its last
+update instead of listing the whole cache. Appends to one file from several
+machines are not safe on a network drive (two machines can write at the
+same offset), so each machine appends to its own cache/index/<host>.txt.
+Processes on one machine share its view of the file, so their appends do
+not collide.
+'''
+
+cache_dir = "cache"
+index_dir = os.path.join(cache_dir, "index")
+entry_pattern = re.compile(r".+-[0-9a-f]{16}\.json$")
+
+
+def cache_key(files, settings):
+    """returns a hash of the contents of files and the analysis settings"""
+    digest = hashlib.sha256()
+    for file in files:
+        digest.update(os.path.basename(file).encode())
+        with open(file, "rb") as infile:
+            digest.update(infile.read())
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    return digest.hexdigest()[:16]
+
+
+def cache_path(plate_id, key):
+    """returns the path of the cached analysis of a plate"""
+    return os.path.join(cache_dir, "%s-%s.json" % (plate_id, key))
+
+
+def cached_figure(plate_id, key):
+    """returns the path of the cached standard curve figure of a plate"""
+    return os.path.join(cache_dir, "%s-%s.png" % (plate_id, key))
+
+
+def save_analysis(analysis, key, fig_path, run):
+    """writes an analysed plate, with the run settings it was called with, and a copy of its standard curve
+    figure (unless fig_path is None, when the cached figure is kept) to the cache"""
+    os.makedirs(cache_dir, exist_ok=True)
+    if fig_path is not None:
+        atomic_copy(fig_path, cached_figure(analysis["plate_id"], key))
+    atomic_write(cache_path(analysis["plate_id"], key), json.dumps(dict(analysis, run=run)))
+    os.makedirs(index_dir, exist_ok=True)
+    with open(os.path.join(index_dir, socket.gethostname() + ".txt"), "a") as outfile:
+        outfile.write(os.path.basename(cache_path(analysis["plate_id"], key)) + "\n")
+
+
+def new_index_entries(offsets):
+    """returns the cache files saved since offsets (the position reached in each machine's index file), oldest
+    first, the new offsets and the index lines that do not name a cache entry"""
+    if not os.path.isdir(index_dir):
+        return [], dict(offsets), []
+    cache_files = []
+    bad_lines = []
+    new_offsets = dict(offsets)
+    for index_name in sorted(os.listdir(index_dir)):
+        offset = offsets.get(index_name, 0)
+        with open(os.path.join(index_dir, index_name), "rb") as infile:
+            infile.seek(offset)
+            new_lines = infile.read()
+        #a line still being written is left for the next update
+        complete = new_lines[:new_lines.rfind(b"\n") + 1]
+        new_offsets[index_name] = offset + len(complete)
+        for line in complete.decode(errors="replace").splitlines():
+            cache_file = os.path.join(cache_dir, line.strip())
+            if entry_pattern.match(line.strip()) and os.path.exists(cache_file):
+                cache_files.append(cache_file)
+            else:
+                bad_lines.append("%s: %r" % (index_name, line))
+    return sorted(cache_files, key=os.path.getmtime), new_offsets, bad_lines
+
+
+def load_analysis(plate_id, key):
+    """returns the cached analysis of a plate or None if there is none for this key"""
+    try:
+        with open(cache_path(plate_id, key)) as infile:
+            return json.load(infile)
+    except FileNotFoundError:
+        return None
+
+
+def matches_run(analysis, run):
+    """returns True if a cached analysis was called with every setting in run"""
+    recorded = analysis.get("run", {})
+    return all(recorded.get(name) == value for name, value in run.items())
+
+
+def plate_cache_files(plate_id):
+    """returns the cache files of a plate, newest first"""
+    cache_files = glob.glob(os.path.join(cache_dir, glob.escape(plate_id) + "-" + "[0-9a-f]" * 16 + ".json"))
+    return sorted(cache_files, key=os.path.getmtime, reverse=True)
+
+
+def latest_analysis(plate_id, run):
+    """returns the most recently cached analysis of a plate called with the settings in run (for example
+    {"antigen": "s"}), or None if there is none"""
+    for cache_file in plate_cache_files(plate_id):
+        with open(cache_file) as infile:
+            analysis = json.load(infile)
+        if matches_run(analysis, run):
+            return analysis
+    return None
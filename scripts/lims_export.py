@@ -0,0 +1,285 @@
+import os
+import sys
+import json
+import glob
+import time
+import queue
+import shutil
+import hashlib
+import tempfile
+import threading
+import http.client
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from outputs import atomic_write
+
+'''
+Export of per-sample results to the LIMS over HTTP. The rows of many plateID.csv
+files (leaving out EMPTY wells) are sent as json batches of batch_rows rows per
+POST, over a small pool of keep-alive connections used by that many sender
+threads. Every row carries a row_key (a hash of its plate ID, sample ID and
+dilution), so a row that is sent again, after a retry or in an overlapping
+export with other batch sizes, is only stored once, and every batch has an
+Idempotency-Key header (a hash of its row keys). Connection errors and 5xx
+responses are retried with a growing wait. A batch that still fails is
+spooled to lims_spool/ and sent before anything else on the next export. A
+spooled batch the LIMS rejects (a 4xx response) is moved to lims_spool/rejected/,
+as sending it again would not help, and is left there for someone to look at. Once
+one batch has failed all its retries the LIMS is taken to be down and the
+remaining batches are spooled straight away instead of each waiting through
+its own retries.
+
+Run this file directly to start a local stand-in for the LIMS, or to time an
+export against one:
+python scripts/lims_export.py serve port
+python scripts/lims_export.py benchmark n-rows connections
+'''
+
+spool_dir = "lims_spool"
+rejected_dir = os.path.join(spool_dir, "rejected")
+retries = 4
+retry_seconds = 0.5
+timeout_seconds = 30
+
+
+def row_key(row):
+    """returns the key the LIMS stores a result row under, from its plate ID, sample ID and dilution"""
+    return hashlib.sha256(("%s\t%s\t%s" % (row["plateid"], row["sampleid"], row["dilution"])).encode()).hexdigest()[:32]
+
+
+def read_rows(csv_files):
+    """returns the rows of plate result csv files as dictionaries with the plate ID and row key added.
+    EMPTY wells are left out"""
+    rows = []
+    for csv_file in csv_files:
+        plate_id = os.path.basename(csv_file)[:-len(".csv")]
+        with open(csv_file) as infile:
+            header = next(infile).rstrip("\n").split(", ")
+            for line in infile:
+                row = {"plateid": plate_id}
+                row.update(zip(header, line.rstrip("\n").split(", ")))
+                if row["dilution"] == "NA":
+                    continue
+                row["row_key"] = row_key(row)
+                rows.append(row)
+    return rows
+
+
+def make_batches(rows, batch_rows):
+    """returns (idempotency key, json body) of batches of batch_rows rows"""
+    batches = []
+    for start in range(0, len(rows), batch_rows):
+        batch = rows[start:start + batch_rows]
+        body = json.dumps({"rows": batch}, sort_keys=True).encode()
+        key = hashlib.sha256("".join(row["row_key"] for row in batch).encode()).hexdigest()[:32]
+        batches.append((key, body))
+    return batches
+
+
+class ConnectionPool:
+    """keep-alive connections to one host, handed out to one sender thread at a time"""
+
+    def __init__(self, url, size):
+        parts = urllib.parse.urlsplit(url)
+        self.path = parts.path or "/"
+        if parts.scheme == "https":
+            self.connection_class = http.client.HTTPSConnection
+        else:
+            self.connection_class = http.client.HTTPConnection
+        self.netloc = parts.netloc
+        self.connections = queue.Queue()
+        for i in range(size):
+            self.connections.put(self.connection_class(self.netloc, timeout=timeout_seconds))
+
+    def post(self, key, body):
+        """posts body on a pooled connection and returns the response status. A broken connection is
+        replaced by a new one before the error is raised"""
+        connection = self.connections.get()
+        try:
+            connection.request("POST", self.path, body=body,
+                               headers={"Content-Type": "application/json", "Idempotency-Key": key})
+            response = connection.getresponse()
+            response.read()
+            if response.getheader("Connection", "").lower() == "close":
+                connection.close()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection = self.connection_class(self.netloc, timeout=timeout_seconds)
+            raise
+        finally:
+            self.connections.put(connection)
+
+    def close(self):
+        """closes every connection of the pool"""
+        while not self.connections.empty():
+            self.connections.get().close()
+
+
+def send_batch(pool, key, body, lims_down):
+    """posts one batch, retrying connection errors and 5xx responses. Returns "sent" once the LIMS has it,
+    "rejected" for a 4xx response (retrying will not help) and "failed" otherwise. A batch that fails every
+    retry sets the lims_down event, and once it is set batches fail without being sent"""
+    for attempt in range(retries + 1):
+        if lims_down.is_set():
+            return "failed"
+        try:
+            status = pool.post(key, body)
+            if status < 300:
+                return "sent"
+            if status < 500:
+                print("LIMS rejected batch %s with status %s" % (key, status))
+                return "rejected"
+        except (OSError, http.client.HTTPException):
+            pass
+        if attempt < retries:
+            time.sleep(retry_seconds * 2 ** attempt)
+    lims_down.set()
+    return "failed"
+
+
+def spooled_batches():
+    """returns (idempotency key, json body) of the batches waiting in the spool directory"""
+    batches = []
+    for spool_file in sorted(glob.glob(os.path.join(spool_dir, "*.json"))):
+        with open(spool_file, "rb") as infile:
+            batches.append((os.path.basename(spool_file)[:-len(".json")], infile.read()))
+    return batches
+
+
+def export_batches(url, batches, connections):
+    """sends batches over a pool of connections, spools the ones that failed and moves spooled ones the LIMS
+    rejected to the rejected directory of the spool. Returns the outcome of each batch"""
+    pool = ConnectionPool(url, connections)
+    lims_down = threading.Event()
+    try:
+        with ThreadPoolExecutor(connections) as executor:
+            outcomes = list(executor.map(lambda batch: send_batch(pool, *batch, lims_down), batches))
+    finally:
+        pool.close()
+
+    for (key, body), outcome in zip(batches, outcomes):
+        spool_file = os.path.join(spool_dir, key + ".json")
+        if outcome == "sent" and os.path.exists(spool_file):
+            os.remove(spool_file)
+        elif outcome == "failed" and not os.path.exists(spool_file):
+            os.makedirs(spool_dir, exist_ok=True)
+            atomic_write(spool_file, body.decode())
+        elif outcome == "rejected" and os.path.exists(spool_file):
+            os.makedirs(rejected_dir, exist_ok=True)
+            os.replace(spool_file, os.path.join(rejected_dir, key + ".json"))
+            print("Moved rejected spooled batch %s to %s, it is not sent again" % (key, rejected_dir))
+    return outcomes
+
+
+def run_export(csv_files, url, batch_rows, connections):
+    """exports the rows of csv_files (after anything left in the spool) and prints the rows per second"""
+    rows = read_rows(csv_files)
+    batches = spooled_batches() + make_batches(rows, batch_rows)
+    spooled_rows = sum(len(json.loads(body)["rows"]) for key, body in batches) - len(rows)
+    print("Exporting %s rows from %s files and %s spooled rows to %s in %s batches over %s connections"
+          % (len(rows), len(csv_files), spooled_rows, url, len(batches), connections))
+    start = time.time()
+    outcomes = export_batches(url, batches, connections)
+    seconds = time.time() - start
+    print("%s batches sent, %s rejected, %s spooled to %s, %.0f rows/s"
+          % (outcomes.count("sent"), outcomes.count("rejected"), outcomes.count("failed"), spool_dir,
+             (len(rows) + spooled_rows) / seconds))
+    if outcomes.count("failed") > 0:
+        print("The LIMS could not be reached, the spooled batches are sent first on the next export")
+    return outcomes
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """stand-in LIMS that stores each row key once"""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        rows = json.loads(body)["rows"]
+        with self.server.lock:
+            new_keys = {row["row_key"] for row in rows} - self.server.row_keys
+            self.server.row_keys |= new_keys
+        reply = json.dumps({"stored": len(new_keys), "duplicates": len(rows) - len(new_keys)}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def stand_in_server(port=0):
+    """returns a stand-in LIMS server on localhost, serving from a background thread"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), StandInHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.row_keys = set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def post_once(url, key, body):
+    """posts body on a new connection that is closed afterwards"""
+    pool = ConnectionPool(url, 1)
+    try:
+        return pool.post(key, body)
+    finally:
+        pool.close()
+
+
+def benchmark(n_rows, connections, batch_rows=500):
+    """times an export of n_rows synthetic rows to stand-in servers, one plate per request on a new connection
+    against batches on pooled connections, checks rows resent in batches of another size are stored once and
+    times an export to a LIMS that is down"""
+    rows = [{"plateid": "synthetic%05d" % (i // 32), "sampleid": "S%07d" % i, "dilution": "100",
+             "od": "0.5", "cv": "0.02", "abunits": "12.5", "posneg": "Pos"} for i in range(n_rows)]
+    for row in rows:
+        row["row_key"] = row_key(row)
+
+    server = stand_in_server()
+    url = "http://127.0.0.1:%s/results" % server.server_address[1]
+    start = time.time()
+    for key, body in make_batches(rows, 32):
+        post_once(url, key, body)
+    print("one plate per request:     %8.0f rows/s" % (n_rows / (time.time() - start)))
+    server.shutdown()
+    server.server_close()
+
+    server = stand_in_server()
+    url = "http://127.0.0.1:%s/results" % server.server_address[1]
+    batches = make_batches(rows, batch_rows)
+    start = time.time()
+    outcomes = export_batches(url, batches, connections)
+    print("%s rows x %s connections: %8.0f rows/s" % (batch_rows, connections, n_rows / (time.time() - start)))
+    export_batches(url, make_batches(rows, batch_rows // 2 + 7), connections)
+    print("all batches sent: %s, rows stored once after resending in other batches: %s"
+          % (outcomes.count("sent") == len(batches), len(server.row_keys) == n_rows))
+    server.shutdown()
+    server.server_close()
+
+    #the stopped server's port refuses connections, so every batch is spooled
+    global spool_dir
+    spool_dir = tempfile.mkdtemp(prefix="lims-spool-")
+    start = time.time()
+    outcomes = export_batches(url, batches, connections)
+    print("LIMS down: %s of %s batches spooled in %.1f seconds" % (outcomes.count("failed"), len(batches),
+                                                                    time.time() - start))
+    shutil.rmtree(spool_dir)
+
+if __name__ == "__main__":
+    if sys.argv[1] == "serve":
+        server = stand_in_server(int(sys.argv[2]))
+        print("Stand-in LIMS on http://127.0.0.1:%s/, ctrl-c to stop" % sys.argv[2])
+        try:
+            while True:
+                time.sleep(60)
+                print("%s rows stored" % len(server.row_keys))
+        except KeyboardInterrupt:
+            server.shutdown()
+    else:
+        benchmark(int(sys.argv[2]), int(sys.argv[3]))
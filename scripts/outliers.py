@@ -0,0 +1,92 @@
+import numpy as np
+
+'''
+Automatic detection of outlier wells from the replicate groups on a plate, as
+an alternative to listing bad wells by hand in a plateID-ignore.csv file.
+
+Two rules are used:
+ - groups of three or more wells (the blanks) use a robust z-score,
+   0.6745 * (od - median) / MAD, and any well above z_max is an outlier.
+ - duplicate wells (samples, controls and the paired standards of the two
+   standard curves) are checked against cv_max. For a standard, the well that
+   is furthest (in log OD) from the curve through its neighbouring standards
+   is the outlier. For samples and controls there is no way to tell which of
+   the two wells is wrong so the pair is only flagged.
+'''
+
+
+def robust_z(group_ods):
+    """returns robust z-scores of a group of wells based on the median and median absolute deviation"""
+    median = np.nanmedian(group_ods)
+    mad = np.nanmedian(np.abs(group_ods - median))
+    if mad == 0:
+        return np.zeros(len(group_ods))
+    return 0.6745 * (group_ods - median) / mad
+
+
+def pair_cv(pair_ods):
+    """returns the cv of each row of an (n x 2) array of duplicate wells"""
+    return np.std(pair_ods, axis=1) / np.mean(pair_ods, axis=1)
+
+
+def std_neighbour_distance(std1_ods, std2_ods):
+    """returns how far each standard well is, in log OD, from the curve through its neighbouring standards"""
+    log_means = np.log(np.clip(np.nanmean([std1_ods, std2_ods], axis=0), 1e-6, None))
+    expected = np.empty(len(log_means))
+    expected[1:-1] = (log_means[:-2] + log_means[2:]) / 2
+    expected[0] = 2 * log_means[1] - log_means[2]
+    expected[-1] = 2 * log_means[-2] - log_means[-3]
+    distance1 = np.abs(np.log(np.clip(std1_ods, 1e-6, None)) - expected)
+    distance2 = np.abs(np.log(np.clip(std2_ods, 1e-6, None)) - expected)
+    return distance1, distance2
+
+
+def find_outliers(ods, std_curve1_cells, std_curve2_cells, ignore_wells, exclude, cv_max=0.2, z_max=3.5):
+    """returns a list of [well, group, rule, action] for outlier wells. Wells already in ignore_wells are skipped.
+    action is "exclude" for wells that should be removed and "flag" for wells that are only reported"""
+    action = "exclude" if exclude else "flag"
+    outliers = []
+
+    # blanks and any other group with 3 or more wells
+    for group in ods.keys():
+        wells = [well for well in ods[group].keys() if well not in ignore_wells]
+        if len(wells) >= 3 and group not in ["std_curve1", "std_curve2"]:
+            z = robust_z(np.asarray([ods[group][well] for well in wells], dtype=float))
+            for i in np.flatnonzero(np.abs(z) > z_max):
+                outliers.append([wells[i], group, "z=%.2f" % z[i], action])
+
+    # duplicate samples and controls
+    pairs = [group for group in ods.keys() if len(ods[group]) == 2
+             and not any(well in ignore_wells for well in ods[group].keys())]
+    if len(pairs) > 0:
+        pair_ods = np.asarray([list(ods[group].values()) for group in pairs], dtype=float)
+        cvs = pair_cv(pair_ods)
+        for i in np.flatnonzero(cvs > cv_max):
+            for well in ods[pairs[i]].keys():
+                outliers.append([well, pairs[i], "cv=%.2f" % cvs[i], "flag"])
+
+    # paired standards, NaN where a well is already ignored
+    std1_ods = np.asarray([np.nan if well in ignore_wells else ods["std_curve1"][well]
+                           for well in std_curve1_cells], dtype=float)
+    std2_ods = np.asarray([np.nan if well in ignore_wells else ods["std_curve2"][well]
+                           for well in std_curve2_cells], dtype=float)
+    cvs = pair_cv(np.column_stack([std1_ods, std2_ods]))
+    distance1, distance2 = std_neighbour_distance(std1_ods, std2_ods)
+    for i in np.flatnonzero(cvs > cv_max):
+        if distance1[i] >= distance2[i]:
+            outliers.append([std_curve1_cells[i], "std_curve1", "cv=%.2f" % cvs[i], action])
+        else:
+            outliers.append([std_curve2_cells[i], "std_curve2", "cv=%.2f" % cvs[i], action])
+
+    return outliers
+
+
+def outlier_file_text(outliers, settings):
+    """returns the text of a generated ignore file. Flagged wells are written as comments"""
+    lines = ["# generated by elisa_dl.py %s\n" % settings]
+    for well, group, rule, action in outliers:
+        if action == "exclude":
+            lines.append("%s,%s,%s\n" % (well, group, rule))
+        else:
+            lines.append("# %s,%s,%s flagged only\n" % (well, group, rule))
+    return "".join(lines)
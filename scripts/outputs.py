@@ -0,0 +1,92 @@
+import os
+import uuid
+import shutil
+import socket
+import datetime
+
+'''
+Output helpers. Every file is first written to a uniquely named temporary file
+in the destination directory and then renamed over the final name, so readers
+never see a partially written report and concurrent runs never interleave
+their writes. Runs given a run ID write into their own runs/<run-id>/ directory
+with the same figs/ and html_reports/ layout as the elisa-dl directory.
+'''
+
+def new_run_id():
+    """returns a run ID that is unique across threads, processes and machines"""
+    now = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    return "%s-%s-%s-%s" % (now, socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+
+
+def output_dir(run_id=None):
+    """returns the directory outputs of a run go to, creating the figs directories if needed"""
+    if run_id is None:
+        out_dir = "."
+    else:
+        out_dir = os.path.join("runs", run_id)
+    os.makedirs(os.path.join(out_dir, "figs"), exist_ok=True)
+    os.makedirs(os.path.join(out_dir, "html_reports", "figs"), exist_ok=True)
+    return out_dir
+
+
+def temp_path(path, suffix=".tmp"):
+    """returns the path of a new, uniquely named empty file next to path, with the mode of a new file"""
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, ".%s-%s%s" % (name, uuid.uuid4().hex, suffix))
+    #created with mode 0o666 so the process umask applies, as for any other new file
+    os.close(os.open(tmp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+    return tmp_path
+
+
+def atomic_write(path, text):
+    """writes text to a temporary file next to path and renames it into place"""
+    tmp_path = temp_path(path)
+    try:
+        with open(tmp_path, "w") as outfile:
+            outfile.write(text)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def atomic_savefig(fig, path):
+    """saves a matplotlib figure to a temporary file next to path and renames it into place"""
+    tmp_path = temp_path(path)
+    try:
+        fig.savefig(tmp_path, format=os.path.splitext(path)[1][1:])
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def atomic_pdf(html_page, out_dir, pdf_file):
+    """renders html_page to pdf_file. The html is written to out_dir so relative figure paths resolve"""
+    import pdfkit
+    tmp_html = temp_path(os.path.join(out_dir, os.path.basename(pdf_file)), suffix=".html")
+    tmp_pdf = temp_path(pdf_file, suffix=".pdf")
+    try:
+        with open(tmp_html, "w") as htmlfile:
+            htmlfile.write(html_page)
+        pdfkit.from_file(tmp_html, tmp_pdf)
+        os.replace(tmp_pdf, pdf_file)
+    except BaseException:
+        if os.path.exists(tmp_pdf):
+            os.remove(tmp_pdf)
+        raise
+    finally:
+        os.remove(tmp_html)
+
+
+def atomic_copy(src, dst):
+    """copies src to a temporary file next to dst and renames it into place"""
+    tmp_path = temp_path(dst)
+    try:
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -1,157 +1,168 @@
+import os
+import csv
+import numpy as np
 from openpyxl import load_workbook
 
+def cell_range(first, last):
+    """returns the cell coordinates of a range within one row, e.g. B23 to M23"""
+    row = first[1:]
+    return [chr(col) + row for col in range(ord(first[0]), ord(last[0]) + 1)]
+
+
+#wells of each group on the plate, in the order they are reported
+plate_layout = {"std_curve1": cell_range("B23", "M23"),
+                "std_curve2": cell_range("B24", "M24"),
+                "pos": cell_range("F22", "G22"),
+                "blk": cell_range("J22", "M22"),
+                "neg": cell_range("H22", "I22")}
+for sample_num in range(32):
+    sample_row = str(17 + sample_num // 6)
+    sample_col = "BDFHJL"[sample_num % 6]
+    plate_layout["sample%02d" % (sample_num + 1)] = cell_range(sample_col + sample_row,
+                                                               chr(ord(sample_col) + 1) + sample_row)
+
+layout_wells = [well for group in plate_layout for well in plate_layout[group]]
+well_index = dict(zip(layout_wells, range(len(layout_wells))))
+
+#plate reader file formats in the order they are looked for
+reader_extensions = [".xlsx", ".xls", ".txt", ".csv"]
+
+
+def plate_row(ods):
+    """returns the ods of a plate as a row in layout_wells order with NaN for excluded wells"""
+    row = np.full(len(layout_wells), np.nan)
+    for group in ods.keys():
+        for well in ods[group].keys():
+            row[well_index[well]] = ods[group][well]
+    return row
+
+
 def get_ods(file):
     wb = load_workbook(file)
     od_ws = wb["Photometric1"]
-    ods={}
-    std_curve1 = {}
-    for cell in od_ws["B23":"M23"][0]:
-        std_curve1[cell.coordinate] = cell.value
-    ods["std_curve1"] = std_curve1
-    std_curve2 = {}
-    for cell in od_ws["B24":"M24"][0]:
-        std_curve2[cell.coordinate] = cell.value
-    ods["std_curve2"] = std_curve2
-    pos = {}
-    for cell in od_ws["F22":"G22"][0]:
-        pos[cell.coordinate] = cell.value
-    ods["pos"] = pos
-    blk = {}
-    for cell in od_ws["J22":"M22"][0]:
-        blk[cell.coordinate] = cell.value
-    ods["blk"] =  blk
-    neg = {}
-    for cell in od_ws["H22":"I22"][0]:
-        neg[cell.coordinate] = cell.value
-    ods["neg"] = neg
-    sample01 = {}
-    for cell in od_ws["B17":"C17"][0]:
-        sample01[cell.coordinate] = cell.value
-    ods["sample01"] = sample01
-    sample02 = {}
-    for cell in od_ws["D17":"E17"][0]:
-        sample02[cell.coordinate] = cell.value
-    ods["sample02"] = sample02
-    sample03 = {}
-    for cell in od_ws["F17":"G17"][0]:
-        sample03[cell.coordinate] = cell.value
-    ods["sample03"] = sample03
-    sample04 = {}
-    for cell in od_ws["H17":"I17"][0]:
-        sample04[cell.coordinate] = cell.value
-    ods["sample04"] = sample04
-    sample05 = {}
-    for cell in od_ws["J17":"K17"][0]:
-        sample05[cell.coordinate] = cell.value
-    ods["sample05"] = sample05
-    sample06 = {}
-    for cell in od_ws["L17":"M17"][0]:
-        sample06[cell.coordinate] = cell.value
-    ods["sample06"] = sample06
-    sample07 = {}
-    for cell in od_ws["B18":"C18"][0]:
-        sample07[cell.coordinate] = cell.value
-    ods["sample07"] = sample07
-    sample08 = {}
-    for cell in od_ws["D18":"E18"][0]:
-        sample08[cell.coordinate] = cell.value
-    ods["sample08"] = sample08
-    sample09 = {}
-    for cell in od_ws["F18":"G18"][0]:
-        sample09[cell.coordinate] = cell.value
-    ods["sample09"] = sample09
-    sample10 = {}
-    for cell in od_ws["H18":"I18"][0]:
-        sample10[cell.coordinate] = cell.value
-    ods["sample10"] = sample10
-    sample11 = {}
-    for cell in od_ws["J18":"K18"][0]:
-        sample11[cell.coordinate] = cell.value
-    ods["sample11"] = sample11
-    sample12 = {}
-    for cell in od_ws["L18":"M18"][0]:
-        sample12[cell.coordinate] = cell.value
-    ods["sample12"] = sample12
-    sample13 = {}
-    for cell in od_ws["B19":"C19"][0]:
-        sample13[cell.coordinate] = cell.value
-    ods["sample13"] = sample13
-    sample14 = {}
-    for cell in od_ws["D19":"E19"][0]:
-        sample14[cell.coordinate] = cell.value
-    ods["sample14"] = sample14
-    sample15 = {}
-    for cell in od_ws["F19":"G19"][0]:
-        sample15[cell.coordinate] = cell.value
-    ods["sample15"] = sample15
-    sample16 = {}
-    for cell in od_ws["H19":"I19"][0]:
-        sample16[cell.coordinate] = cell.value
-    ods["sample16"] = sample16
-    sample17 = {}
-    for cell in od_ws["J19":"K19"][0]:
-        sample17[cell.coordinate] = cell.value
-    ods["sample17"] = sample17
-    sample18 = {}
-    for cell in od_ws["L19":"M19"][0]:
-        sample18[cell.coordinate] = cell.value
-    ods["sample18"] = sample18
-    sample19 = {}
-    for cell in od_ws["B20":"C20"][0]:
-        sample19[cell.coordinate] = cell.value
-    ods["sample19"] = sample19
-    sample20 = {}
-    for cell in od_ws["D20":"E20"][0]:
-        sample20[cell.coordinate] = cell.value
-    ods["sample20"] = sample20
-    sample21 = {}
-    for cell in od_ws["F20":"G20"][0]:
-        sample21[cell.coordinate] = cell.value
-    ods["sample21"] = sample21
-    sample22 = {}
-    for cell in od_ws["H20":"I20"][0]:
-        sample22[cell.coordinate] = cell.value
-    ods["sample22"] = sample22
-    sample23 = {}
-    for cell in od_ws["J20":"K20"][0]:
-        sample23[cell.coordinate] = cell.value
-    ods["sample23"] = sample23
-    sample24 = {}
-    for cell in od_ws["L20":"M20"][0]:
-        sample24[cell.coordinate] = cell.value
-    ods["sample24"] = sample24
-    sample25 = {}
-    for cell in od_ws["B21":"C21"][0]:
-        sample25[cell.coordinate] = cell.value
-    ods["sample25"] = sample25
-    sample26 = {}
-    for cell in od_ws["D21":"E21"][0]:
-        sample26[cell.coordinate] = cell.value
-    ods["sample26"] = sample26
-    sample27 = {}
-    for cell in od_ws["F21":"G21"][0]:
-        sample27[cell.coordinate] = cell.value
-    ods["sample27"] = sample27
-    sample28 = {}
-    for cell in od_ws["H21":"I21"][0]:
-        sample28[cell.coordinate] = cell.value
-    ods["sample28"] = sample28
-    sample29 = {}
-    for cell in od_ws["J21":"K21"][0]:
-        sample29[cell.coordinate] = cell.value
-    ods["sample29"] = sample29
-    sample30 = {}
-    for cell in od_ws["L21":"M21"][0]:
-        sample30[cell.coordinate] = cell.value
-    ods["sample30"] = sample30
-    sample31 = {}
-    for cell in od_ws["B22":"C22"][0]:
-        sample31[cell.coordinate] = cell.value
-    ods["sample31"] = sample31
-    sample32 = {}
-    for cell in od_ws["D22":"E22"][0]:
-        sample32[cell.coordinate] = cell.value
-    ods["sample32"] = sample32
+    ods = {}
+    for group in plate_layout.keys():
+        group_ods = {}
+        for well in plate_layout[group]:
+            group_ods[well] = od_ws[well].value
+        ods[group] = group_ods
+    return ods
+
+
+def get_reads(file):
+    """returns the names of all Photometric sheets and a (read x well) array of their ods in layout_wells order"""
+    wb = load_workbook(file, read_only=True, data_only=True)
+    sheet_names = [name for name in wb.sheetnames if name.startswith("Photometric")]
+    reads = np.empty((len(sheet_names), len(layout_wells)))
+    for read_num, name in enumerate(sheet_names):
+        sheet_ods = {}
+        rows = wb[name].iter_rows(min_row=17, max_row=24, min_col=2, max_col=13, values_only=True)
+        for row_num, row in enumerate(rows):
+            for col_num, value in enumerate(row):
+                sheet_ods[chr(ord("B") + col_num) + str(17 + row_num)] = value
+        reads[read_num] = [sheet_ods[well] for well in layout_wells]
+    wb.close()
+    return sheet_names, reads
+
+
+def get_reads_xls(file):
+    """returns the names of all Photometric sheets and a (read x well) array of their ods from a legacy .xls
+    plate reader file. Only the Photometric sheets are loaded"""
+    try:
+        import xlrd
+    except ImportError:
+        raise ImportError("Reading .xls plate reader files needs xlrd, install it with 'pip install xlrd'")
+    wb = xlrd.open_workbook(file, on_demand=True)
+    sheet_names = [name for name in wb.sheet_names() if name.startswith("Photometric")]
+    reads = np.empty((len(sheet_names), len(layout_wells)))
+    for read_num, name in enumerate(sheet_names):
+        od_ws = wb.sheet_by_name(name)
+        #the ods must be in the Value block at A16, as in the .xlsx files, with the row labels A to H
+        labels = [str(od_ws.cell_value(row, 0)).strip() if row < od_ws.nrows else "" for row in range(15, 24)]
+        if labels != ["Value"] + list("ABCDEFGH"):
+            raise ValueError("Sheet %s of plate reader file %s does not have a Value block with rows A to H at "
+                             "A16, found %s" % (name, file, labels))
+        reads[read_num] = [od_ws.cell_value(int(well[1:]) - 1, ord(well[0]) - ord("A")) for well in layout_wells]
+        wb.unload_sheet(name)
+    wb.release_resources()
+    return sheet_names, reads
+
+
+def get_reads_text(file):
+    """returns read names and a (read x well) array of ods from a tab, comma or semicolon separated text
+    export (fields may be quoted). Each read is a block starting with a 'Value' header line followed by the
+    plate rows A to H, each the row label and 12 ods, as in the Photometric sheets. The file is read line by
+    line and only the value blocks are parsed"""
+    reads = []
+    block = None
+    with open(file, newline="") as infile:
+        sample = infile.read(65536)
+        infile.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters="\t,;")
+        except csv.Error:
+            dialect = csv.excel_tab if "\t" in sample else csv.excel
+        for line_num, fields in enumerate(csv.reader(infile, dialect), 1):
+            fields = [field.strip() for field in fields]
+            if len(fields) > 0 and fields[0] == "Value":
+                block = []
+            elif block is not None:
+                while len(fields) > 0 and fields[-1] == "":
+                    fields.pop()
+                row_label = "ABCDEFGH"[len(block)]
+                try:
+                    if len(fields) != 13 or fields[0] != row_label:
+                        raise ValueError
+                    block.append([float(field) for field in fields[1:]])
+                except ValueError:
+                    raise ValueError("Line %s of plate reader file %s should be row %s of a Value block (the row "
+                                     "label and 12 ods), found %s" % (line_num, file, row_label, fields))
+                if len(block) == 8:
+                    reads.append([block[int(well[1:]) - 17][ord(well[0]) - ord("B")] for well in layout_wells])
+                    block = None
+    if block is not None:
+        raise ValueError("The last Value block of plate reader file %s has only %s rows" % (file, len(block)))
+    if len(reads) == 0:
+        raise ValueError("No 'Value' block found in plate reader file %s" % file)
+    sheet_names = ["Photometric%s" % (read_num + 1) for read_num in range(len(reads))]
+    return sheet_names, np.asarray(reads)
+
+
+def find_reader_file(plate_id):
+    """returns the plate reader file of a plate, trying .xlsx, .xls, .txt and .csv in that order"""
+    for extension in reader_extensions:
+        reader_file = plate_id + "-preader" + extension
+        if os.path.exists(reader_file):
+            return reader_file
+    return plate_id + "-preader.xlsx"
+
+
+def combine_reads(sheet_names, reads, reference_sheet=None, average_reads=False):
+    """returns one od per well from a (read x well) array. The reference sheet is subtracted from every
+    other read and then either the reads are averaged or the first one is used"""
+    if reference_sheet is not None:
+        if reference_sheet not in sheet_names:
+            raise ValueError("Reference sheet %s not found, sheets are %s" % (reference_sheet, sheet_names))
+        is_reference = np.asarray([name == reference_sheet for name in sheet_names])
+        if is_reference.all():
+            raise ValueError("Reference sheet %s is the only read, there is no read to subtract it from"
+                             % reference_sheet)
+        reads = reads[~is_reference] - reads[is_reference]
+    if average_reads:
+        return reads.mean(axis=0)
+    return reads[0]
+
+
+def ods_from_values(values):
+    """returns the ods dictionary used by elisa_dl.py from an array of ods in layout_wells order"""
+    ods = {}
+    well_num = 0
+    for group in plate_layout.keys():
+        group_ods = {}
+        for well in plate_layout[group]:
+            group_ods[well] = values[well_num].item()
+            well_num += 1
+        ods[group] = group_ods
     return ods
 
 
@@ -192,4 +203,17 @@ def get_samples(file):
                "sample31": sample_ws["B22"].value,
                "sample32": sample_ws["D22"].value
                }
-    return sample_dilution
\ No newline at end of file
+    return sample_dilution
+
+
+def read_ignore_file(file):
+    """returns a dictionary of bad wells and their group from an ignore file with lines like 'B17,sample01_1'.
+    Lines starting with # are comments"""
+    ignore_wells = {}
+    with open(file) as infile:
+        for line in infile:
+            fields = line.strip().split(",")
+            if fields[0] == "" or fields[0].startswith("#"):
+                continue
+            ignore_wells[fields[0].strip()] = fields[1].strip() if len(fields) > 1 else ""
+    return ignore_wells
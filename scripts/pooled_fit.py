@@ -0,0 +1,126 @@
+import os
+import sys
+import time
+import numpy as np
+from scipy.optimize import leastsq, least_squares
+from scipy.sparse import lil_matrix
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import elisa_dl
+from elisa_dl import logistic4, residuals
+
+'''
+Run-level pooled standard curve fitting. Each plate only has 12 duplicate
+standards, so noisy plates can give unstable slopes (B) and EC50s (C). Here
+the 4PL curves of all plates in a run are fitted together as one least
+squares problem in which some parameters are shared by every plate (by
+default the slope B) and the rest are fitted per plate. Each plate's
+residuals only depend on the shared parameters and its own, so the jacobian
+is given to the solver as a sparse pattern and the cost of a step grows
+linearly with the number of plates. Plates of different antigens or standard
+curves are different assays and never share parameters: a run is split into
+one pooled fit per antigen and std-curve.
+'''
+
+param_names = ["A", "B", "C", "D"]
+
+
+def pooled_fit(xs, ys, shared="B"):
+    """fits the 4PL to the standards of many plates with the parameters named in shared common to all plates.
+    Returns a (plates x 4) array of pooled parameters and one of independently fitted parameters"""
+    n_plates = len(xs)
+    shared_cols = [col for col, name in enumerate(param_names) if name in shared]
+    plate_cols = [col for col, name in enumerate(param_names) if name not in shared]
+    n_shared = len(shared_cols)
+    n_plate = len(plate_cols)
+
+    # independent fits of each plate are the starting point
+    independent = np.asarray([leastsq(residuals, [0, 1, 1, 1], args=(y, x))[0] for x, y in zip(xs, ys)])
+
+    x_all = np.concatenate(xs)
+    y_all = np.concatenate(ys)
+    plate_of = np.repeat(np.arange(n_plates), [len(x) for x in xs])
+
+    def unpack(p):
+        params = np.empty((n_plates, 4))
+        params[:, shared_cols] = p[:n_shared]
+        params[:, plate_cols] = p[n_shared:].reshape(n_plates, n_plate)
+        return params
+
+    def pooled_residuals(p):
+        params = unpack(p)[plate_of]
+        return y_all - logistic4(x_all, params[:, 0], params[:, 1], params[:, 2], params[:, 3])
+
+    sparsity = lil_matrix((len(y_all), n_shared + n_plates * n_plate), dtype=int)
+    sparsity[:, :n_shared] = 1
+    for col in range(n_plate):
+        sparsity[np.arange(len(y_all)), n_shared + plate_of * n_plate + col] = 1
+
+    p0 = np.concatenate([np.median(independent[:, shared_cols], axis=0), independent[:, plate_cols].ravel()])
+    fit = least_squares(pooled_residuals, p0, jac_sparsity=sparsity, method="trf", tr_solver="lsmr", x_scale="jac")
+    return unpack(fit.x), independent
+
+
+def pooled_deviation(xs, ys, pooled, independent):
+    """returns per-plate rms residuals from the pooled and independent curves, the largest difference between
+    the two curves over the standards and each plate's A, C and D relative to the run median (as fractions)"""
+    run_median = np.median(pooled, axis=0)
+    deviation = []
+    for plate_num, (x, y) in enumerate(zip(xs, ys)):
+        pooled_curve = logistic4(x, *pooled[plate_num])
+        independent_curve = logistic4(x, *independent[plate_num])
+        deviation.append({"rms_pooled": np.sqrt(np.mean((y - pooled_curve) ** 2)),
+                          "rms_independent": np.sqrt(np.mean((y - independent_curve) ** 2)),
+                          "max_curve_difference": np.max(np.abs(pooled_curve - independent_curve)),
+                          "A_vs_run": pooled[plate_num][0] / run_median[0] - 1,
+                          "C_vs_run": pooled[plate_num][2] / run_median[2] - 1,
+                          "D_vs_run": pooled[plate_num][3] / run_median[3] - 1})
+    return deviation
+
+
+def run_pooled(plate_runs, conc_index, shared, options, out_dir):
+    """fits the standard curves of a run of (plate_id, antigen, std_curve) jointly, one pooled fit for each
+    antigen and std-curve, writes each plate's csv file using its pooled curve and a pooled-fit.csv summary of
+    the fitted parameters and each plate's deviation from the pooled curve of its group"""
+    groups = {}
+    for plate_id, antigen, std_curve in plate_runs:
+        groups.setdefault((antigen, std_curve), []).append(plate_id)
+
+    summary_lines = ["plateid, antigen, std_curve, A, B, C, D, rms_pooled, rms_independent, max_curve_difference, "
+                     "A_vs_run, C_vs_run, D_vs_run\n"]
+    all_pooled = {}
+    all_deviation = {}
+    for (antigen, std_curve), plate_ids in groups.items():
+        analyses = [elisa_dl.clean_plate(plate_id, std_curve, options, out_dir) for plate_id in plate_ids]
+        xs = [np.asarray(analysis["std_concs"]) for analysis in analyses]
+        ys = [(np.asarray(list(analysis["ods"]["std_curve1"].values()))
+               + np.asarray(list(analysis["ods"]["std_curve2"].values()))) / 2.0 for analysis in analyses]
+
+        print("Fitting pooled standard curve to %s %s plates (%s std-curve) with %s shared"
+              % (len(analyses), elisa_dl.antigens[antigen], std_curve, shared))
+        start = time.time()
+        pooled, independent = pooled_fit(xs, ys, shared)
+        print("Pooled fit took %.2f seconds" % (time.time() - start))
+        deviation = pooled_deviation(xs, ys, pooled, independent)
+
+        for analysis, plate_id, params, plate_deviation, y in zip(analyses, plate_ids, pooled, deviation, ys):
+            summary_lines.append(", ".join([plate_id, antigen, std_curve] + [str(round(param, 6)) for param in params]
+                                           + [str(round(plate_deviation[name], 4)) for name in
+                                              ["rms_pooled", "rms_independent", "max_curve_difference",
+                                               "A_vs_run", "C_vs_run", "D_vs_run"]]) + "\n")
+            all_pooled[plate_id] = params
+            all_deviation[plate_id] = plate_deviation
+
+            if conc_index == "index" and len(analysis["failed_index_stds"]) >= 2:
+                print("Plate %s: index positive/negative call failed as 2 or more CVs >10%%" % plate_id)
+                continue
+            analysis["plsq"] = params.tolist()
+            analysis["y"] = y.tolist()
+            sample_means, sample_concs, pos_neg = elisa_dl.classify_samples(analysis, antigen, conc_index)
+            elisa_dl.atomic_write(os.path.join(out_dir, plate_id + ".csv"),
+                                  elisa_dl.results_csv(analysis, sample_means, sample_concs, pos_neg))
+
+    summary_file = os.path.join(out_dir, "pooled-fit.csv")
+    elisa_dl.atomic_write(summary_file, "".join(summary_lines))
+    print("Pooled fit summary written to %s" % summary_file)
+    return all_pooled, all_deviation
@@ -0,0 +1,135 @@
+import os
+import sys
+import numpy as np
+from outputs import atomic_write
+
+'''
+Reconciliation of samples that were run at more than one dilution, possibly
+on different plates. Reads the plateID.csv result files of a batch, indexes
+the results by sample ID and for each sample picks the in-range result (an
+Ab-Units value, not AboveCurve/BelowCurve) with the lowest dilution factor
+and reports its dilution corrected Ab-Units (Ab-Units x dilution). Samples
+without an in-range result go on a worklist with a suggested dilution for
+the re-run:
+ - only AboveCurve results: the highest dilution tested x dilution_step
+ - only BelowCurve results: the lowest dilution tested / dilution_step
+ - AboveCurve at a lower dilution than a BelowCurve result: the geometric
+   mean of the two closest such dilutions
+All of the per-sample work is done with numpy group operations so it scales
+to thousands of samples.
+'''
+
+
+def read_results(csv_files):
+    """returns arrays of sample IDs, plate IDs, dilutions, Ab-Units (NaN if out of range), curve flags
+    (-1 below, 0 in range, 1 above) and Pos/Neg calls from plate result csv files, or the results.csv of a
+    stream with its plateid column. EMPTY wells are skipped"""
+    rows = []
+    for csv_file in csv_files:
+        plate_id = os.path.basename(csv_file)[:-len(".csv")]
+        with open(csv_file) as infile:
+            header = next(infile).rstrip("\n").split(", ")
+            for line in infile:
+                row = {"plateid": plate_id}
+                row.update(zip(header, line.rstrip("\n").split(", ")))
+                if row.get("dilution", "NA") != "NA" and "abunits" in row and "posneg" in row:
+                    rows.append([row["sampleid"], row["plateid"], row["dilution"], row["abunits"], row["posneg"]])
+    if len(rows) == 0:
+        raise ValueError("No sample results found in %s" % ", ".join(csv_files))
+    sample_ids, plate_ids, dilutions, abunits, posneg = np.asarray(rows).T
+    flags = np.zeros(len(abunits), dtype=int)
+    flags[abunits == "BelowCurve"] = -1
+    flags[abunits == "AboveCurve"] = 1
+    abunits = np.where(flags == 0, abunits, "nan").astype(float)
+    return sample_ids, plate_ids, dilutions.astype(float), abunits, flags, posneg
+
+
+def reconcile(sample_ids, dilutions, flags, dilution_step=10):
+    """returns the unique sample IDs, the row index of the chosen in-range result of each sample (-1 if there
+    is none), the number of results and in-range results of each sample, and for samples without one a
+    worklist status and suggested dilution"""
+    samples, sample_of = np.unique(sample_ids, return_inverse=True)
+    n_samples = len(samples)
+    in_range = flags == 0
+
+    # lowest in-range dilution first within each sample
+    order = np.lexsort((dilutions, ~in_range, sample_of))
+    first = order[np.unique(sample_of[order], return_index=True)[1]]
+    chosen = np.where(in_range[first], first, -1)
+
+    n_results = np.bincount(sample_of, minlength=n_samples)
+    n_in_range = np.bincount(sample_of, weights=in_range, minlength=n_samples).astype(int)
+
+    max_above = np.full(n_samples, -np.inf)
+    np.maximum.at(max_above, sample_of[flags == 1], dilutions[flags == 1])
+    min_below = np.full(n_samples, np.inf)
+    np.minimum.at(min_below, sample_of[flags == -1], dilutions[flags == -1])
+    # the closest BelowCurve dilution above the highest AboveCurve dilution brackets the curve range
+    below_above = np.full(n_samples, np.inf)
+    brackets = (flags == -1) & (dilutions > max_above[sample_of])
+    np.minimum.at(below_above, sample_of[brackets], dilutions[brackets])
+
+    has_above = np.isfinite(max_above)
+    has_below = np.isfinite(min_below)
+    status = np.full(n_samples, "", dtype=object)
+    suggested = np.full(n_samples, np.nan)
+    out_of_range = chosen == -1
+
+    only_above = out_of_range & has_above & ~has_below
+    status[only_above] = "AboveCurve"
+    suggested[only_above] = max_above[only_above] * dilution_step
+
+    only_below = out_of_range & has_below & ~has_above
+    status[only_below] = "BelowCurve"
+    suggested[only_below] = min_below[only_below] / dilution_step
+
+    bracketed = out_of_range & has_above & np.isfinite(below_above)
+    status[bracketed] = "BetweenDilutions"
+    suggested[bracketed] = np.sqrt(max_above[bracketed] * below_above[bracketed])
+
+    inconsistent = out_of_range & has_above & has_below & ~bracketed
+    status[inconsistent] = "Inconsistent"
+    return samples, chosen, n_results, n_in_range, status, suggested
+
+
+def run_reconcile(csv_files, dilution_step, out_dir):
+    """reconciles the results in csv_files and writes reconciled.csv and worklist.csv to out_dir"""
+    try:
+        sample_ids, plate_ids, dilutions, abunits, flags, posneg = read_results(csv_files)
+    except ValueError as error:
+        print(error)
+        sys.exit(1)
+    samples, chosen, n_results, n_in_range, status, suggested = reconcile(sample_ids, dilutions, flags,
+                                                                          dilution_step)
+    print("Reconciling %s results of %s samples from %s files" % (len(sample_ids), len(samples), len(csv_files)))
+
+    in_range = chosen >= 0
+    rows = chosen[in_range]
+    corrected = abunits[rows] * dilutions[rows]
+    reconciled_lines = ["sampleid, plateid, dilution, abunits, corrected_abunits, posneg, n_results, n_in_range\n"]
+    for sample, row, corrected_abunits, results, results_in_range in zip(samples[in_range], rows, corrected,
+                                                                         n_results[in_range],
+                                                                         n_in_range[in_range]):
+        reconciled_lines.append("%s, %s, %s, %s, %s, %s, %s, %s\n"
+                                % (sample, plate_ids[row], "%g" % dilutions[row], abunits[row],
+                                   round(corrected_abunits, 3), posneg[row], results, results_in_range))
+
+    # dilutions already tested for each out of range sample, for the worklist
+    tested = {}
+    out_of_range_rows = np.isin(sample_ids, samples[~in_range])
+    for sample, dilution in zip(sample_ids[out_of_range_rows], dilutions[out_of_range_rows]):
+        tested.setdefault(sample, set()).add("%g" % dilution)
+
+    worklist_lines = ["sampleid, status, tested_dilutions, suggested_dilution\n"]
+    for sample, sample_status, sample_suggested in zip(samples[~in_range], status[~in_range],
+                                                       suggested[~in_range]):
+        suggestion = "NA" if np.isnan(sample_suggested) else "%g" % round(sample_suggested)
+        worklist_lines.append("%s, %s, %s, %s\n" % (sample, sample_status,
+                                                    " ".join(sorted(tested[sample], key=float)), suggestion))
+
+    reconciled_file = os.path.join(out_dir, "reconciled.csv")
+    worklist_file = os.path.join(out_dir, "worklist.csv")
+    atomic_write(reconciled_file, "".join(reconciled_lines))
+    atomic_write(worklist_file, "".join(worklist_lines))
+    print("%s samples reconciled, written to %s" % (in_range.sum(), reconciled_file))
+    print("%s samples still out of range, written to %s" % ((~in_range).sum(), worklist_file))
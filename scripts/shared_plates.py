@@ -0,0 +1,224 @@
+import os
+import sys
+import time
+import shutil
+import pickle
+import tempfile
+import numpy as np
+from multiprocessing import Pool
+from scipy.optimize import leastsq
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import elisa_dl
+from elisa_dl import residuals, get_conc, cut_offs, index_cutoffs, index_stds, std_concs_dict
+from plate_plans import plate_layout, layout_wells, well_index, plate_row
+
+'''
+Batch transport for fitting and classifying many plates in worker processes.
+Instead of pickling the dict-of-dict ods of every plate to the workers, all
+parsed plates are written once into a contiguous (plates x wells) float array
+in a memory-mapped .npy file (in /dev/shm when available, so it never touches
+disk) with excluded wells as NaN. Workers map the file and fit and classify
+their block of plates on views of it, so only the file name and a block
+range are sent to them and only the small per-plate results come back.
+
+Run this file directly to compare memory and throughput with pickled dicts:
+python scripts/shared_plates.py n-plates processes
+'''
+
+std1_idx = np.asarray([well_index[well] for well in plate_layout["std_curve1"]])
+std2_idx = np.asarray([well_index[well] for well in plate_layout["std_curve2"]])
+blk_idx = np.asarray([well_index[well] for well in plate_layout["blk"]])
+sample_names = [group for group in plate_layout.keys() if "sample" in group]
+sample_idx = np.asarray([[well_index[well] for well in plate_layout[sample]] for sample in sample_names])
+
+
+def pack_plates(plates, std_curves):
+    """writes a list of (plate_id, ods) into memory-mapped (plates x wells) and (plates x standards) arrays,
+    with the concentrations of each plate's standard curve in std_curves. Standards whose wells were both
+    excluded get a NaN concentration. Returns the batch metadata"""
+    shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    batch_dir = tempfile.mkdtemp(prefix="elisa-dl-batch-", dir=shm_dir)
+    meta = {"dir": batch_dir,
+            "ods_file": os.path.join(batch_dir, "ods.npy"),
+            "concs_file": os.path.join(batch_dir, "concs.npy"),
+            "plate_ids": [plate_id for plate_id, ods in plates]}
+    plate_ods = np.lib.format.open_memmap(meta["ods_file"], mode="w+", shape=(len(plates), len(layout_wells)))
+    plate_concs = np.lib.format.open_memmap(meta["concs_file"], mode="w+", shape=(len(plates), len(std1_idx)))
+    plate_concs[:] = [std_concs_dict[std_curve] for std_curve in std_curves]
+    for plate_num, (plate_id, ods) in enumerate(plates):
+        plate_ods[plate_num] = plate_row(ods)
+    plate_concs[np.isnan(plate_ods[:, std1_idx])] = np.nan
+    plate_ods.flush()
+    plate_concs.flush()
+    del plate_ods, plate_concs
+    return meta
+
+
+def release_plates(meta):
+    """removes the memory-mapped files of a batch"""
+    shutil.rmtree(meta["dir"], ignore_errors=True)
+
+
+def check_standards_array(std1, std2):
+    """returns the bad standards, failed index standards and index standard means of one plate.
+    Matches check_standards in elisa_dl.py"""
+    std_pairs = np.column_stack([std1, std2])
+    std_cvs = np.std(std_pairs, axis=1) / std_pairs.mean(axis=1)
+    bad_stds = {}
+    for std_num in np.flatnonzero(std_cvs >= 0.1):
+        bad_stds["Std" + str(std_num + 1)] = round(std_cvs[std_num].item(), 3)
+    failed_index_stds = [index_std for index_std in index_stds if index_std in bad_stds]
+    std_means = (std1[8:11] + std2[8:11]) / 2
+    return bad_stds, failed_index_stds, std_means
+
+
+def analyse_block(meta, start, stop, antigens, conc_index):
+    """fits and classifies plates start:stop of a packed batch, with antigens the antigen of each plate.
+    Returns a list of per-plate result dicts"""
+    plate_ods = np.load(meta["ods_file"], mmap_mode="r")[start:stop]
+    plate_concs = np.load(meta["concs_file"], mmap_mode="r")[start:stop]
+
+    raw_sample_ods = plate_ods[:, sample_idx]
+    sample_cvs = np.round(np.nanstd(raw_sample_ods, axis=2) / np.nanmean(raw_sample_ods, axis=2), 2)
+    blk_means = np.nanmean(plate_ods[:, blk_idx], axis=1)
+    minblk_ods = plate_ods - blk_means[:, None]
+    sample_means = np.nanmean(minblk_ods[:, sample_idx], axis=2)
+
+    results = []
+    for plate_num, antigen in enumerate(antigens):
+        kept = ~np.isnan(plate_concs[plate_num])
+        x = plate_concs[plate_num][kept]
+        std1 = minblk_ods[plate_num, std1_idx][kept]
+        std2 = minblk_ods[plate_num, std2_idx][kept]
+        y = (std1 + std2) / 2.0
+        plsq = leastsq(residuals, [0, 1, 1, 1], args=(y, x))[0]
+        bad_stds, failed_index_stds, std_means = check_standards_array(std1, std2)
+
+        means = sample_means[plate_num]
+        concs = np.round(get_conc(means, plsq), 6).astype(object)
+        concs[means < y[-1]] = "BelowCurve"
+        concs[means > y[0]] = "AboveCurve"
+        rounded_means = np.round(means, 3)
+
+        if conc_index == "conc":
+            positive = rounded_means > cut_offs[antigen]
+        else:
+            valid = np.asarray([index_std not in failed_index_stds for index_std in index_stds])
+            cutoffs = np.asarray([index_cutoffs[antigen][index_std] for index_std in index_stds])
+            above = (means[:, None] / std_means[None, :]) > cutoffs[None, :]
+            positive = (above & valid[None, :]).sum(axis=1) >= 2
+
+        results.append({"plate_id": meta["plate_ids"][start + plate_num],
+                        "plsq": plsq.tolist(),
+                        "y": y.tolist(),
+                        "blk_mean": blk_means[plate_num].item(),
+                        "bad_stds": bad_stds,
+                        "failed_index_stds": failed_index_stds,
+                        "sample_means": dict(zip(sample_names, rounded_means.tolist())),
+                        "sample_cv": dict(zip(sample_names, sample_cvs[plate_num].tolist())),
+                        "sample_concs": dict(zip(sample_names, concs.tolist())),
+                        "pos_neg": dict(zip(sample_names, np.where(positive, "Pos", "Neg").tolist()))})
+    return results
+
+
+def analyse_packed(meta, antigens, conc_index, processes, block_size=64):
+    """fits and classifies every plate of a packed batch, with antigens the antigen of each plate,
+    in a pool of worker processes"""
+    n_plates = len(meta["plate_ids"])
+    blocks = [(meta, start, min(start + block_size, n_plates), antigens[start:start + block_size], conc_index)
+              for start in range(0, n_plates, block_size)]
+    with Pool(processes) as pool:
+        block_results = pool.starmap(analyse_block, blocks)
+    return [result for results in block_results for result in results]
+
+
+def analyse_dict_plate(plate, std_curve, antigen, conc_index):
+    """fits and classifies one plate sent as pickled ods dictionaries, using the elisa_dl.py stages"""
+    plate_id, ods = plate
+    std_concs = [conc for conc, well in zip(std_concs_dict[std_curve], plate_layout["std_curve1"])
+                 if well in ods["std_curve1"]]
+    sample_cv = elisa_dl.get_sample_cvs(ods)
+    blk_mean, blk_cv, ods = elisa_dl.subtract_blanks(ods)
+    x, y, plsq = elisa_dl.fit_std_curve(ods, std_concs)
+    bad_stds, failed_index_stds, std_means = elisa_dl.check_standards(ods)
+    analysis = {"ods": ods, "plsq": plsq, "y": y, "failed_index_stds": failed_index_stds, "std_means": std_means}
+    sample_means, sample_concs, pos_neg = elisa_dl.classify_samples(analysis, antigen, conc_index)
+    return {"plate_id": plate_id, "plsq": plsq.tolist(), "sample_cv": sample_cv,
+            "sample_means": sample_means, "sample_concs": sample_concs, "pos_neg": pos_neg}
+
+
+def run_batch(plate_runs, conc_index, processes, options, out_dir):
+    """reads and cleans a list of (plate_id, antigen, std_curve) in this process, then fits and classifies
+    them in shared-array workers and writes the csv file of each plate"""
+    plates = []
+    sample_dilutions = {}
+    for plate_id, antigen, std_curve in plate_runs:
+        ods, sample_dilution = elisa_dl.read_plate(plate_id, options)
+        ignore_wells, flagged_wells = elisa_dl.get_ignore_wells(plate_id, ods, options, out_dir)
+        ods, std_concs = elisa_dl.exclude_wells(ods, ignore_wells, std_concs_dict[std_curve])
+        plates.append((plate_id, ods))
+        sample_dilutions[plate_id] = sample_dilution
+
+    print("Fitting and classifying %s plates in %s processes" % (len(plates), processes))
+    meta = pack_plates(plates, [std_curve for plate_id, antigen, std_curve in plate_runs])
+    try:
+        results = analyse_packed(meta, [antigen for plate_id, antigen, std_curve in plate_runs], conc_index,
+                                 processes)
+    finally:
+        release_plates(meta)
+
+    for result in results:
+        plate_id = result["plate_id"]
+        if conc_index == "index" and len(result["failed_index_stds"]) >= 2:
+            print("Plate %s: index positive/negative call failed as 2 or more CVs >10%%" % plate_id)
+            continue
+        analysis = {"ods": dict.fromkeys(sample_names),
+                    "sample_dilution": sample_dilutions[plate_id],
+                    "sample_cv": result["sample_cv"]}
+        csv_text = elisa_dl.results_csv(analysis, result["sample_means"], result["sample_concs"], result["pos_neg"])
+        elisa_dl.atomic_write(os.path.join(out_dir, plate_id + ".csv"), csv_text)
+    return results
+
+
+def synthetic_plates(n_plates, seed=0):
+    """returns n_plates copies of the test plate with 5% multiplicative noise on every well"""
+    ods = elisa_dl.get_ods("test-preader.xlsx")
+    rng = np.random.default_rng(seed)
+    plates = []
+    for plate_num in range(n_plates):
+        noisy_ods = {}
+        for group in ods.keys():
+            noisy_ods[group] = {}
+            for well in ods[group].keys():
+                noisy_ods[group][well] = ods[group][well] * rng.normal(1, 0.05)
+        plates.append(("synthetic%05d" % plate_num, noisy_ods))
+    return plates
+
+
+def benchmark(n_plates, processes, antigen="s", std_curve="hero", conc_index="index"):
+    """prints the memory and throughput of the shared array transport against pickled dictionaries"""
+    plates = synthetic_plates(n_plates)
+
+    pickled_bytes = sum(len(pickle.dumps(plate)) for plate in plates)
+    start = time.time()
+    with Pool(processes) as pool:
+        dict_results = pool.starmap(analyse_dict_plate, [(plate, std_curve, antigen, conc_index) for plate in plates])
+    dict_seconds = time.time() - start
+
+    start = time.time()
+    meta = pack_plates(plates, [std_curve] * n_plates)
+    shared_bytes = os.path.getsize(meta["ods_file"]) + os.path.getsize(meta["concs_file"])
+    shared_results = analyse_packed(meta, [antigen] * n_plates, conc_index, processes)
+    release_plates(meta)
+    shared_seconds = time.time() - start
+
+    same_calls = all(a["pos_neg"] == b["pos_neg"] for a, b in zip(dict_results, shared_results))
+    print("%s plates, %s processes" % (n_plates, processes))
+    print("pickled dicts:  %10d bytes sent to workers  %8.1f plates/s" % (pickled_bytes, n_plates / dict_seconds))
+    print("shared array:   %10d bytes mapped by workers %8.1f plates/s" % (shared_bytes, n_plates / shared_seconds))
+    print("same Pos/Neg calls: %s" % same_calls)
+
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]), int(sys.argv[2]))
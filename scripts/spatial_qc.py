@@ -0,0 +1,263 @@
+import os
+import warnings
+import numpy as np
+from plate_plans import plate_layout, layout_wells, plate_row
+from outputs import atomic_write
+
+'''
+Spatial QC of the 96 well grid. Replicates sit side by side (each sample,
+control and blank pair in two neighbouring columns of one row) and the two
+standard curves fill rows G and H, so within one plate the only position
+effects that can be told apart from what is in the wells are:
+ - the difference between the two columns of each pair (columns 1/2, 3/4 ...
+   11/12), from the samples and controls in rows A to F
+ - the difference between rows G and H, from the standards
+ - an edge effect, the mean of columns 1 vs 2, 12 vs 11 and H vs G (the
+   outer well of each of these pairs against the inner one)
+Each is the median over the replicate pairs of log(OD / OD of its replicate),
+about the fraction one well reads above the other, using only pairs where
+both blank subtracted ODs are at least min_od (below that the ratio is
+noise). A plate is flagged if any of these is more than max_bias; with 5%
+noise on each well about 3% of clean plates go over 0.2.
+
+A bias of rows A to F, of one column against the plate or of the top row
+cannot be seen on one plate, because every replicate of those wells is in
+the same row or column pair. Over a batch, different samples sit in each
+position, so the median over the plates of each sample well's log(OD / the
+plate's median sample OD) is its position effect. The mean of these over
+each row, each column and the outer sample wells against the inner ones is
+the batch effect, flagged if it is more than max_effect and more than 3
+standard errors from 0, and only for batches of at least min_plates plates
+(so a small batch does not flag its sample mix). Everything works on
+(plates x wells) arrays, so a whole batch is done in a few numpy operations.
+'''
+
+plate_rows = "ABCDEFGH"
+min_od = 0.1
+max_bias = 0.2
+max_effect = 0.1
+min_plates = 10
+n_se = 3
+
+#grid position of each well of layout_wells, plate reader rows 17-24 and columns B-M are plate rows A-H and 1-12
+grid_rows = np.asarray([int(well[1:]) - 17 for well in layout_wells])
+grid_cols = np.asarray([ord(well[0]) - ord("B") for well in layout_wells])
+grid_order = np.argsort(grid_rows * 12 + grid_cols)
+
+#replicate pairs in neighbouring columns (left well, right well) and the column pair they are in
+column_pairs = ["%s/%s" % (col + 1, col + 2) for col in range(0, 12, 2)]
+pair_left = []
+pair_right = []
+for group, wells in plate_layout.items():
+    if "sample" in group or group in ["pos", "neg"]:
+        pair_left.append(layout_wells.index(wells[0]))
+        pair_right.append(layout_wells.index(wells[1]))
+pair_left = np.asarray(pair_left)
+pair_right = np.asarray(pair_right)
+pair_column = grid_cols[pair_left] // 2
+
+#standards in row G and their replicates in row H
+std_g = np.asarray([layout_wells.index(well) for well in plate_layout["std_curve1"]])
+std_h = np.asarray([layout_wells.index(well) for well in plate_layout["std_curve2"]])
+
+#sample wells and those on the edge of the plate
+sample_wells = np.asarray([layout_wells.index(well) for group, wells in plate_layout.items() if "sample" in group
+                           for well in wells])
+sample_edge = (grid_rows[sample_wells] == 0) | (grid_cols[sample_wells] == 0) | (grid_cols[sample_wells] == 11)
+
+
+def to_grid(values):
+    """returns a (plates x wells) array in layout_wells order as a (plates x 8 x 12) plate grid"""
+    return values[:, grid_order].reshape(len(values), 8, 12)
+
+
+def nanmedian(values, axis):
+    """returns the median ignoring NaN, NaN (without a warning) where there are no values"""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmedian(values, axis=axis)
+
+
+def log_ratio(a, b):
+    """returns log(a / b), NaN where either is below min_od or NaN"""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where((a >= min_od) & (b >= min_od), np.log(a / b), np.nan)
+
+
+def replicate_residuals(plate_ods):
+    """returns the difference of each well from the mean of its replicates relative to that mean (at least
+    min_od), for (plates x wells) ods with NaN for excluded wells. Used to outline wells on the plate map"""
+    residuals = np.full(plate_ods.shape, np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for wells in plate_layout.values():
+            index = [layout_wells.index(well) for well in wells]
+            if len(index) == 12:
+                continue
+            means = np.nanmean(plate_ods[:, index], axis=1, keepdims=True)
+            residuals[:, index] = (plate_ods[:, index] - means) / np.maximum(np.abs(means), min_od)
+        g = plate_ods[:, std_g]
+        h = plate_ods[:, std_h]
+        means = (g + h) / 2
+        residuals[:, std_g] = (g - means) / np.maximum(np.abs(means), min_od)
+        residuals[:, std_h] = (h - means) / np.maximum(np.abs(means), min_od)
+    return residuals
+
+
+def spatial_stats(plate_ods):
+    """returns the column pair (plates x 6), row G vs H (plates) and edge (plates) biases of (plates x wells)
+    blank subtracted ods"""
+    pair_ratios = log_ratio(plate_ods[:, pair_left], plate_ods[:, pair_right])
+    pair_bias = np.column_stack([nanmedian(pair_ratios[:, pair_column == col], axis=1)
+                                 for col in range(len(column_pairs))])
+    gh_bias = nanmedian(log_ratio(plate_ods[:, std_g], plate_ods[:, std_h]), axis=1)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        edge_bias = np.nanmean(np.column_stack([pair_bias[:, 0], -pair_bias[:, -1], -gh_bias]), axis=1)
+    return pair_bias, gh_bias, edge_bias
+
+
+def spatial_flags(pair_bias, gh_bias, edge_bias, limit=max_bias):
+    """returns a list of the biases over limit for each plate"""
+    flags = [[] for i in range(len(edge_bias))]
+    for plate_num, col in zip(*np.nonzero(np.abs(pair_bias) > limit)):
+        flags[plate_num].append("columns %s %+.2f" % (column_pairs[col], pair_bias[plate_num, col]))
+    for plate_num in np.flatnonzero(np.abs(gh_bias) > limit):
+        flags[plate_num].append("rows G/H %+.2f" % gh_bias[plate_num])
+    for plate_num in np.flatnonzero(np.abs(edge_bias) > limit):
+        flags[plate_num].append("edge %+.2f" % edge_bias[plate_num])
+    return flags
+
+
+def position_effects(plate_ods):
+    """returns each sample well's log(OD / the plate's median sample OD) for (plates x wells) ods, NaN for
+    other wells and sample wells below min_od"""
+    samples = plate_ods[:, sample_wells]
+    kept = np.where(samples >= min_od, samples, np.nan)
+    plate_medians = nanmedian(kept, axis=1)
+    effects = np.full(plate_ods.shape, np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        effects[:, sample_wells] = np.log(kept / plate_medians[:, None])
+    return effects
+
+
+def position_medians(plate_ods):
+    """returns the median over plates of each sample well's position effect and its standard error"""
+    effects = position_effects(plate_ods)[:, sample_wells]
+    medians = nanmedian(effects, axis=0)
+    counts = np.sum(~np.isnan(effects), axis=0)
+    mads = nanmedian(np.abs(effects - medians), axis=0)
+    #standard error of a median, from the median absolute deviation as a robust sd
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ses = np.where(counts >= 2, 1.2533 * 1.4826 * mads / np.sqrt(counts), np.nan)
+    return medians, ses
+
+
+def group_effect(medians, ses):
+    """returns the mean of some position medians and its standard error"""
+    kept = ~np.isnan(medians) & ~np.isnan(ses)
+    if not np.any(kept):
+        return np.nan, np.nan
+    return np.mean(medians[kept]), np.sqrt(np.sum(ses[kept] ** 2)) / np.sum(kept)
+
+
+def batch_effects(plate_ods, limit=max_effect):
+    """returns (name, effect, standard error, flagged) for every row and column of the sample wells and for
+    the outer sample wells against the inner ones, over a batch of (plates x wells) ods"""
+    medians, ses = position_medians(plate_ods)
+    rows = grid_rows[sample_wells]
+    cols = grid_cols[sample_wells]
+    groups = [("row %s" % plate_rows[row], group_effect(medians[rows == row], ses[rows == row]))
+              for row in np.unique(rows)]
+    groups += [("column %s" % (col + 1), group_effect(medians[cols == col], ses[cols == col]))
+               for col in np.unique(cols)]
+    edge, edge_se = group_effect(medians[sample_edge], ses[sample_edge])
+    inner, inner_se = group_effect(medians[~sample_edge], ses[~sample_edge])
+    groups.append(("edge", (edge - inner, np.sqrt(edge_se ** 2 + inner_se ** 2))))
+
+    results = []
+    for name, (effect, se) in groups:
+        flagged = len(plate_ods) >= min_plates and abs(effect) > limit and abs(effect) > n_se * se
+        results.append((name, effect, se, bool(flagged)))
+    return results
+
+
+def heatmap_html(od_grid, residual_grid):
+    """returns a compact html table of one plate's blank subtracted ODs on the grid, shaded by OD. Wells more
+    than max_bias from their replicates are outlined, excluded wells are grey"""
+    shades = np.clip(od_grid / np.nanmax(od_grid), 0, 1)
+    lines = ['<table style="font-size:9px"><tr><th style="padding:2px"></th>']
+    lines += ['<th style="padding:2px">%s</th>' % (col + 1) for col in range(12)]
+    lines.append("</tr>")
+    for row in range(8):
+        lines.append('<tr><th style="padding:2px">%s</th>' % plate_rows[row])
+        for col in range(12):
+            od = od_grid[row, col]
+            if np.isnan(od):
+                lines.append('<td style="padding:2px;background-color:#bbbbbb">-</td>')
+                continue
+            level = int(255 - 175 * shades[row, col])
+            border = "2px solid red" if abs(residual_grid[row, col]) > max_bias else "1px solid #dddddd"
+            lines.append('<td style="padding:2px;border:%s;background-color:rgb(%s,%s,255)">%.2f</td>'
+                         % (border, level, level, od))
+        lines.append("</tr>")
+    lines.append("</table>")
+    return "".join(lines)
+
+
+def plate_spatial_html(ods):
+    """returns the spatial QC section of a plate report from its blank subtracted ods"""
+    plate_ods = plate_row(ods)[None, :]
+    pair_bias, gh_bias, edge_bias = spatial_stats(plate_ods)
+    flags = spatial_flags(pair_bias, gh_bias, edge_bias)[0]
+    if len(flags) == 0:
+        flag_text = "no column pair, row G/H or edge bias over %s" % max_bias
+    else:
+        flag_text = "bias over %s: %s" % (max_bias, ", ".join(flags))
+    residual_grid = to_grid(replicate_residuals(plate_ods))[0]
+    return heatmap_html(to_grid(plate_ods)[0], residual_grid), flag_text
+
+
+def run_spatial(analyses, limit, out_dir):
+    """writes spatial-qc.csv with the biases and flags of each analysed plate, spatial-positions.csv with
+    the median position effect of each sample well over the batch and spatial-batch.csv with the batch row,
+    column and edge effects"""
+    plate_ods = np.asarray([plate_row(analysis["ods"]) for analysis in analyses])
+    pair_bias, gh_bias, edge_bias = spatial_stats(plate_ods)
+    flags = spatial_flags(pair_bias, gh_bias, edge_bias, limit)
+
+    lines = ["plateid, " + ", ".join("cols_" + pair.replace("/", "_") for pair in column_pairs)
+             + ", rows_G_H, edge, flags\n"]
+    for analysis, pairs, plate_gh, plate_edge, plate_flags in zip(analyses, pair_bias, gh_bias, edge_bias, flags):
+        lines.append(", ".join([analysis["plate_id"]] + ["%.3f" % bias for bias in pairs]
+                               + ["%.3f" % plate_gh, "%.3f" % plate_edge, " ".join(plate_flags)]) + "\n")
+
+    medians = np.full(len(layout_wells), np.nan)
+    medians[sample_wells] = position_medians(plate_ods)[0]
+    median_grid = to_grid(medians[None, :])[0]
+    position_lines = ["row, " + ", ".join(str(col + 1) for col in range(12)) + "\n"]
+    for row in range(8):
+        position_lines.append(", ".join([plate_rows[row]] + ["NA" if np.isnan(median) else "%.3f" % median
+                                                             for median in median_grid[row]]) + "\n")
+
+    effects = batch_effects(plate_ods)
+    batch_lines = ["position, effect, se, flagged\n"]
+    batch_lines += ["%s, %.3f, %.3f, %s\n" % (name, effect, se, "yes" if flagged else "no")
+                    for name, effect, se, flagged in effects]
+
+    qc_file = os.path.join(out_dir, "spatial-qc.csv")
+    positions_file = os.path.join(out_dir, "spatial-positions.csv")
+    batch_file = os.path.join(out_dir, "spatial-batch.csv")
+    atomic_write(qc_file, "".join(lines))
+    atomic_write(positions_file, "".join(position_lines))
+    atomic_write(batch_file, "".join(batch_lines))
+    flagged = [analysis["plate_id"] for analysis, plate_flags in zip(analyses, flags) if len(plate_flags) > 0]
+    print("%s of %s plates have a column pair, row G/H or edge bias over %s: %s"
+          % (len(flagged), len(analyses), limit, " ".join(flagged)))
+    batch_flagged = ["%s %+.2f" % (name, effect) for name, effect, se, is_flagged in effects if is_flagged]
+    if len(analyses) < min_plates:
+        print("Batch position effects need at least %s plates, none flagged" % min_plates)
+    else:
+        print("Batch position effects over %s: %s"
+              % (max_effect, ", ".join(batch_flagged) if batch_flagged else "none"))
+    print("Spatial QC written to %s, %s and %s" % (qc_file, positions_file, batch_file))
+    return flags, effects
@@ -0,0 +1,137 @@
+import os
+import sys
+import matplotlib.pyplot as plt
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import elisa_dl
+
+try:
+    import resource
+except ImportError:
+    #not available on Windows, peak memory is then not reported
+    resource = None
+
+'''
+Streaming driver for reprocessing large backlogs of plates. Plates are read,
+fitted and called one at a time by a generator and each plate's rows are
+appended to one consolidated csv file as soon as they are ready, so nothing
+is kept for plates that are done. The standard curve figure of each plate is
+saved and closed straight away and the fit goes to the cache as for a single
+plate, so the plates can be reclassified later. Memory use is that of one
+plate however many plates there are; the peak RSS is printed every 100
+plates to show it. Plate IDs can be read from a file (one per line,
+optionally plateID:antigen:std-curve) so the list never has to fit on the command line.
+A plate that cannot be read is listed in stream-failed.csv and the stream
+carries on. Both files are appended to and flushed after every plate, so if
+the stream stops (a crash or Ctrl-C) the plates done so far are kept and
+running it again skips the plate IDs already in either file.
+'''
+
+report_every = 100
+
+
+def plate_list(file):
+    """yields the plate IDs in a plate list file, skipping blank lines and # comments"""
+    with open(file) as infile:
+        for line in infile:
+            line = line.strip()
+            if line != "" and not line.startswith("#"):
+                yield line
+
+
+def peak_rss():
+    """returns the peak resident memory of this process as text in MB"""
+    if resource is None:
+        return "n/a"
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss is in bytes on macOS and in KB on linux
+    if sys.platform == "darwin":
+        max_rss /= 1024
+    return "%.0f MB" % (max_rss / 1024)
+
+
+def open_append(file, header):
+    """returns file opened for appending and the set of plate IDs (first column) already in it. A new file
+    gets the header line, and an incomplete last line (from a stream that was killed) is removed"""
+    plate_ids = set()
+    if os.path.exists(file):
+        with open(file, "rb+") as infile:
+            contents = infile.read()
+            if not contents.endswith(b"\n"):
+                infile.truncate(contents.rfind(b"\n") + 1)
+        with open(file) as infile:
+            lines = infile.readlines()
+        plate_ids = set(line.split(",")[0] for line in lines[1:])
+    outfile = open(file, "a")
+    if outfile.tell() == 0:
+        outfile.write(header)
+    return outfile, plate_ids
+
+
+def stream_plate(plate_id, antigen, std_curve, conc_index, options, out_dir, reports=False):
+    """analyses and calls one plate. Returns its csv rows, or None if the index call failed, and a message"""
+    analysis, fig = elisa_dl.analyse_plate(plate_id, std_curve, options, out_dir)
+    fig_path = os.path.join(out_dir, "figs", plate_id + ".png")
+    elisa_dl.atomic_savefig(fig, fig_path)
+    if reports:
+        elisa_dl.atomic_savefig(fig, os.path.join(out_dir, "html_reports", "figs", plate_id + ".png"))
+    plt.close(fig)
+    key = elisa_dl.cache_key(elisa_dl.input_files(plate_id), elisa_dl.analysis_settings(std_curve, options))
+    run = elisa_dl.run_record(antigen, std_curve, conc_index, out_dir)
+    elisa_dl.save_analysis(analysis, key, fig_path, run)
+
+    if conc_index == "index" and len(analysis["failed_index_stds"]) >= 2:
+        return None, "index positive/negative call failed as 2 or more CVs >10%"
+    if reports:
+        elisa_dl.write_results(analysis, antigen, "no", conc_index, out_dir)
+    sample_means, sample_concs, pos_neg = elisa_dl.classify_samples(analysis, antigen, conc_index)
+    csv_lines = elisa_dl.results_csv(analysis, sample_means, sample_concs, pos_neg).splitlines(True)[1:]
+    return [plate_id + ", " + line for line in csv_lines], "ok"
+
+
+def stream_results(plates, conc_index, options, out_dir, reports=False):
+    """yields (plate_id, csv rows or None, message) for each (plate_id, antigen, std_curve) in plates, analysing
+    one plate at a time. A plate that fails anywhere from reading to writing its rows is yielded with no rows
+    and the reason"""
+    for plate_id, antigen, std_curve in plates:
+        try:
+            rows, message = stream_plate(plate_id, antigen, std_curve, conc_index, options, out_dir, reports)
+        except SystemExit:
+            #read_plate and the option checks print what is wrong and exit, which only ends this plate
+            plt.close("all")
+            rows, message = None, "failed (the reason is printed in the stream output)"
+        except Exception as error:
+            plt.close("all")
+            rows, message = None, "failed: %s: %s" % (type(error).__name__, error)
+        yield plate_id, rows, message
+
+
+def run_stream(plates, conc_index, options, out_dir, reports=False):
+    """streams plates into out_dir/results.csv and lists plates without results in out_dir/stream-failed.csv,
+    skipping plates already in either file from an earlier run"""
+    results_file = os.path.join(out_dir, "results.csv")
+    failed_file = os.path.join(out_dir, "stream-failed.csv")
+    plate_count = 0
+    failed_count = 0
+    results, done_ids = open_append(results_file, "plateid, sampleid, dilution, od, cv, abunits, posneg\n")
+    with results:
+        failed, failed_ids = open_append(failed_file, "plateid, reason\n")
+        with failed:
+            done_ids |= failed_ids
+            if len(done_ids) > 0:
+                print("Resuming, skipping %s plates already in %s or %s" % (len(done_ids), results_file, failed_file))
+            plates = (plate for plate in plates if plate[0] not in done_ids)
+            for plate_id, rows, message in stream_results(plates, conc_index, options, out_dir, reports):
+                plate_count += 1
+                if rows is None:
+                    failed_count += 1
+                    print("Plate %s: %s" % (plate_id, message))
+                    failed.write("%s, %s\n" % (plate_id, message))
+                    failed.flush()
+                else:
+                    results.write("".join(rows))
+                    results.flush()
+                if plate_count % report_every == 0:
+                    print("%s plates done, peak RSS %s" % (plate_count, peak_rss()))
+    print("%s plates streamed to %s, %s without results (see %s), peak RSS %s"
+          % (plate_count, results_file, failed_count, failed_file, peak_rss()))
@@ -39,6 +39,8 @@ html = """
  <p style="font-size:12px"> <b>Negative control</b>  mean: %s   CV: %s</p>
  <p style="font-size:12px"> <b>Standards</b>  %s</p>
  <p style="font-size:12px"> <b>Exclusions</b>  %s</p>
+ <p style="font-size:12px"> <b>Plate map</b>  %s</p>
+ %s
 
 <font size="2">
  <table>
@@ -312,4 +314,125 @@ html = """
  </body>
  </html>
 
- """
\ No newline at end of file
+ """
+dashboard_html = """
+ <html>
+ <head>
+ <meta charset="utf-8">
+ <title>Plate dashboard</title>
+ <script src="dashboard-plates.js"></script>
+ </head>
+ <body>
+
+ <style>
+ body {
+   font-family: arial, sans-serif;
+ }
+
+ table {
+   border-collapse: collapse;
+   margin-left:auto;margin-right:auto;
+   font-size:12px;
+ }
+
+ td, th {
+   border: 1px solid #dddddd;
+   text-align: left;
+   padding: 4px;
+ }
+
+ th {
+   background-color: #dddddd;
+ }
+
+ .ok { background-color: #ddffdd; }
+ .check { background-color: #ffffcc; }
+ .fail { background-color: #ffdddd; }
+ </style>
+
+ <h1 style="font-size:24px"> Plate Dashboard</h1>
+
+ <p style="font-size:12px">
+   Plate ID <input id="search" oninput="show(0)">
+   QC <select id="qc" onchange="show(0)"><option value="">all</option><option>ok</option><option>check</option><option>fail</option></select>
+   <span id="count"></span>
+   <button onclick="show(page - 1)">previous</button> <span id="page"></span> <button onclick="show(page + 1)">next</button>
+ </p>
+
+ <table>
+   <thead>
+   <tr>
+     <th>Plate</th>
+     <th>Analysed</th>
+     <th>Antigen</th>
+     <th>Method</th>
+     <th>QC</th>
+     <th>Blank mean / CV</th>
+     <th>Pos mean / CV</th>
+     <th>Neg mean / CV</th>
+     <th>Bad standards</th>
+     <th>Failed index standards</th>
+     <th>Pos</th>
+     <th>Neg</th>
+     <th>Above / Below curve</th>
+   </tr>
+   </thead>
+   <tbody id="plates"></tbody>
+ </table>
+
+ <script>
+ var pageSize = 50;
+ var page = 0;
+
+ function matching() {
+   var search = document.getElementById("search").value.toLowerCase();
+   var qc = document.getElementById("qc").value;
+   return plateOrder.slice().reverse().filter(function (id) {
+     var plate = plates[id];
+     return id.toLowerCase().indexOf(search) >= 0 && (qc == "" || plate.qc == qc);
+   });
+ }
+
+ function cell(text) {
+   var td = document.createElement("td");
+   td.textContent = text;
+   return td;
+ }
+
+ function show(newPage) {
+   var ids = matching();
+   var pages = Math.max(1, Math.ceil(ids.length / pageSize));
+   page = Math.min(Math.max(newPage, 0), pages - 1);
+   var body = document.getElementById("plates");
+   body.innerHTML = "";
+   ids.slice(page * pageSize, (page + 1) * pageSize).forEach(function (id) {
+     var plate = plates[id];
+     var row = document.createElement("tr");
+     var first = document.createElement("td");
+     if (plate.report) {
+       var link = document.createElement("a");
+       link.href = plate.report;
+       link.textContent = id;
+       first.appendChild(link);
+     } else {
+       first.textContent = id;
+     }
+     row.appendChild(first);
+     [plate.analysed, plate.antigen, plate.method].forEach(function (text) { row.appendChild(cell(text)); });
+     var qc = cell(plate.qc + (plate.qc_notes.length ? ": " + plate.qc_notes.join(", ") : ""));
+     qc.className = plate.qc;
+     row.appendChild(qc);
+     [plate.blk, plate.pos, plate.neg, plate.bad_stds, plate.failed_index_stds, plate.n_pos, plate.n_neg,
+      plate.above + " / " + plate.below].forEach(function (text) { row.appendChild(cell(text)); });
+     body.appendChild(row);
+   });
+   document.getElementById("count").textContent = ids.length + " of " + plateOrder.length + " plates";
+   document.getElementById("page").textContent = "page " + (page + 1) + " of " + pages;
+ }
+
+ show(0);
+ </script>
+
+ </body>
+ </html>
+"""
@@ -0,0 +1,302 @@
+import os
+import sys
+import json
+import time
+import numpy as np
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import elisa_dl
+import shared_plates
+import pooled_fit
+from plate_plans import plate_row, get_ods, get_reads, get_reads_xls, get_reads_text, find_reader_file
+from plate_plans import combine_reads, ods_from_values, reader_extensions
+
+'''
+Differential check of the faster engines against the plate by plate
+elisa_dl.py stages, before any of them is trusted with production plates.
+The reference stages are first checked against plateID-golden-conc.csv and
+plateID-golden-index.csv, the results of the original elisa_dl.py (before
+any of the engines were added) for the real plates that have them (the test
+plate does). The same plates (real plates with their ignore files and noisy
+synthetic copies of the test plate) then go through the reference stages
+and each alternative:
+ - ingest: the openpyxl cell by cell reader of the plate reader file
+   against the read-only .xlsx reader, and against the .xls, .txt and .csv
+   readers for every plate that also has a plate reader export in that
+   format (plateID-preader.xls ..., the test plate has all three), so they
+   are checked on files in the repository rather than files this script
+   writes
+ - fit and call: the shared-array batch engine, in this process and in
+   worker processes, the pooled fit with no shared parameters (which should
+   find each plate's own curve) and calls from a cached analysis after a
+   json round trip (the reclassify path)
+Fit parameters and concentrations must agree within rtol, and the
+Above/BelowCurve flags and Pos/Neg calls must be identical. The pooled fit
+uses a different optimiser (trust region rather than Levenberg-Marquardt),
+which stops at a slightly different point on the flat 4PL surface (its
+parameters differ by up to 4e-4 on 200 synthetic plates, with the same or a
+lower sum of squares), so for it the fitted curve at the standard
+concentrations is held to rtol instead of the parameters. Any difference
+is a failure. An engine that could not be checked (no plate has an export
+in its format, or no plate has golden results) is reported as SKIP, which
+is a failure only with --strict. The time of each engine and its speedup
+over the reference stage are printed side by side.
+
+python scripts/verify_engines.py n-synthetic-plates [plateID ...] [--strict]
+'''
+
+rtol = 1e-4
+
+
+def reference_plate(plate_id, ods, ignore_wells, std_curve, antigen, conc_index):
+    """fits and calls one plate with the elisa_dl.py stages. Returns the analysis and calls"""
+    ods, std_concs = elisa_dl.exclude_wells(ods, ignore_wells, elisa_dl.std_concs_dict[std_curve])
+    sample_cv = elisa_dl.get_sample_cvs(ods)
+    blk_mean, blk_cv, ods = elisa_dl.subtract_blanks(ods)
+    x, y, plsq = elisa_dl.fit_std_curve(ods, std_concs)
+    bad_stds, failed_index_stds, std_means = elisa_dl.check_standards(ods)
+    analysis = {"plate_id": plate_id, "ods": ods, "std_concs": std_concs, "sample_cv": sample_cv,
+                "plsq": plsq.tolist(), "y": y.tolist(), "failed_index_stds": failed_index_stds,
+                "std_means": std_means}
+    sample_means, sample_concs, pos_neg = elisa_dl.classify_samples(analysis, antigen, conc_index)
+    return analysis, {"plsq": plsq.tolist(), "sample_concs": sample_concs, "pos_neg": pos_neg}
+
+
+def split_concs(sample_concs):
+    """returns an array of concentrations (NaN when out of range) and of curve flags (-1 below, 1 above)"""
+    values = list(sample_concs.values())
+    flags = np.asarray([{"BelowCurve": -1, "AboveCurve": 1}.get(str(value), 0) for value in values])
+    concs = np.asarray([np.nan if flag != 0 else float(value) for value, flag in zip(values, flags)])
+    return concs, flags
+
+
+def relative_difference(a, b):
+    """returns the largest relative difference between two arrays, ignoring positions that are NaN in both"""
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    both_nan = np.isnan(a) & np.isnan(b)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        difference = np.abs(a - b) / np.maximum(np.abs(a), 1e-12)
+    difference[both_nan] = 0
+    difference = np.where(np.isnan(difference), np.inf, difference)
+    return difference.max() if difference.size > 0 else 0.0
+
+
+def compare_calls(reference, results, std_concs=None):
+    """returns the largest parameter (or, if the standard concentrations of each plate are given, fitted curve
+    at the standards) and concentration differences and the number of Above/BelowCurve flag and Pos/Neg call
+    differences of an engine's per-plate results against the reference"""
+    param_difference = 0
+    conc_difference = 0
+    flag_mismatches = 0
+    call_mismatches = 0
+    for num, (ref, result) in enumerate(zip(reference, results)):
+        if std_concs is None:
+            param_difference = max(param_difference, relative_difference(ref["plsq"], result["plsq"]))
+        else:
+            x = np.asarray(std_concs[num], dtype=float)
+            param_difference = max(param_difference, relative_difference(elisa_dl.logistic4(x, *ref["plsq"]),
+                                                                         elisa_dl.logistic4(x, *result["plsq"])))
+        ref_concs, ref_flags = split_concs(ref["sample_concs"])
+        concs, flags = split_concs(result["sample_concs"])
+        conc_difference = max(conc_difference, relative_difference(ref_concs, concs))
+        flag_mismatches += int((ref_flags != flags).sum())
+        call_mismatches += sum(ref["pos_neg"][sample] != result["pos_neg"][sample] for sample in ref["pos_neg"])
+    return param_difference, conc_difference, flag_mismatches, call_mismatches
+
+
+def read_golden(file):
+    """returns the rows of a results csv file as lists of fields, without the header"""
+    with open(file) as infile:
+        return [[field.strip() for field in line.split(",")] for line in infile.readlines()[1:]]
+
+
+def same_field(a, b):
+    """returns True if two csv fields are the same text or numbers within rtol"""
+    try:
+        return relative_difference([float(a)], [float(b)]) <= rtol
+    except ValueError:
+        return a == b
+
+
+def verify_golden(real_plates, std_curve, antigen, conc_index):
+    """returns (engine, seconds, reference seconds, differing rows or a reason it was skipped, comparison)
+    for the reference stages against the golden results of the (plate_id, raw ods, ignore_wells,
+    sample_dilution) real_plates that have them"""
+    checked = 0
+    mismatches = 0
+    start = time.time()
+    for plate_id, ods, ignore_wells, sample_dilution in real_plates:
+        golden_file = "%s-golden-%s.csv" % (plate_id, conc_index)
+        if not os.path.exists(golden_file):
+            print("Plate %s has no %s, its reference results are not checked" % (plate_id, golden_file))
+            continue
+        analysis, calls = reference_plate(plate_id, ods, ignore_wells, std_curve, antigen, conc_index)
+        analysis["sample_dilution"] = sample_dilution
+        sample_means, sample_concs, pos_neg = elisa_dl.classify_samples(analysis, antigen, conc_index)
+        rows = [[field.strip() for field in line.split(",")]
+                for line in elisa_dl.results_csv(analysis, sample_means, sample_concs, pos_neg).splitlines()[1:]]
+        golden = read_golden(golden_file)
+        mismatches += abs(len(rows) - len(golden))
+        mismatches += sum(len(row) != len(golden_row) or not all(map(same_field, row, golden_row))
+                          for row, golden_row in zip(rows, golden))
+        checked += 1
+    seconds = time.time() - start
+    name = "reference vs golden %s csv" % conc_index
+    if checked == 0:
+        return (name, seconds, seconds, "no real plate has golden results", "rows")
+    return (name, seconds, seconds, mismatches, "rows")
+
+
+def read_export(file):
+    """returns the ods (in layout_wells order) of a plate reader file with the reader for its format"""
+    if file.endswith(".xlsx"):
+        return plate_row(get_ods(file))
+    readers = {".xls": get_reads_xls, ".txt": get_reads_text, ".csv": get_reads_text}
+    return plate_row(ods_from_values(combine_reads(*readers[os.path.splitext(file)[1]](file))))
+
+
+def verify_ingest(plate_ids):
+    """returns (engine, seconds, reference seconds, mismatched wells or a reason it was skipped, comparison)
+    for each reader against the cell by cell read of each plate's plate reader file"""
+    reader_files = [find_reader_file(plate_id) for plate_id in plate_ids]
+    start = time.time()
+    reference = [read_export(reader_file) for reader_file in reader_files]
+    reference_seconds = time.time() - start
+
+    rows = []
+    start = time.time()
+    xlsx_plates = [(values, reader_file) for values, reader_file in zip(reference, reader_files)
+                   if reader_file.endswith(".xlsx")]
+    mismatches = sum(int((values != plate_row(ods_from_values(combine_reads(*get_reads(reader_file))))).sum())
+                     for values, reader_file in xlsx_plates)
+    rows.append(("read-only xlsx", time.time() - start, reference_seconds,
+                 mismatches if xlsx_plates else "no plate has an .xlsx plate reader file", "wells"))
+
+    for extension in reader_extensions[1:]:
+        start = time.time()
+        exports = [(values, plate_id + "-preader" + extension)
+                   for plate_id, values, reader_file in zip(plate_ids, reference, reader_files)
+                   if os.path.exists(plate_id + "-preader" + extension) and not reader_file.endswith(extension)]
+        mismatches = sum(int((values != read_export(export_file)).sum()) for values, export_file in exports)
+        rows.append(("%s export (%s plates)" % (extension, len(exports)), time.time() - start, reference_seconds,
+                     mismatches if exports else "no plate has a %s plate reader export to compare" % extension,
+                     "wells"))
+    return rows
+
+
+def verify_engines(plates, std_curve, antigen, conc_index, processes=2):
+    """runs (plate_id, raw ods, ignore_wells) plates through the reference stages and every alternative
+    engine. Returns (engine, seconds, reference seconds, comparison, what the first comparison is) rows"""
+    start = time.time()
+    reference = [reference_plate(plate_id, ods, ignore_wells, std_curve, antigen, conc_index)
+                 for plate_id, ods, ignore_wells in plates]
+    reference_seconds = time.time() - start
+    analyses = [analysis for analysis, calls in reference]
+    reference_calls = [calls for analysis, calls in reference]
+    rows = []
+
+    cleaned = [(plate_id, elisa_dl.exclude_wells(ods, ignore_wells, elisa_dl.std_concs_dict[std_curve])[0])
+               for plate_id, ods, ignore_wells in plates]
+    meta = shared_plates.pack_plates(cleaned, [std_curve] * len(plates))
+    try:
+        start = time.time()
+        results = shared_plates.analyse_block(meta, 0, len(plates), [antigen] * len(plates), conc_index)
+        rows.append(("shared array, 1 process", time.time() - start, reference_seconds,
+                     compare_calls(reference_calls, results), "params"))
+        start = time.time()
+        results = shared_plates.analyse_packed(meta, [antigen] * len(plates), conc_index, processes)
+        rows.append(("shared array, %s processes" % processes, time.time() - start, reference_seconds,
+                     compare_calls(reference_calls, results), "params"))
+    finally:
+        shared_plates.release_plates(meta)
+
+    start = time.time()
+    xs = [np.asarray(analysis["std_concs"]) for analysis in analyses]
+    ys = [np.asarray(analysis["y"]) for analysis in analyses]
+    pooled, independent = pooled_fit.pooled_fit(xs, ys, shared="")
+    results = []
+    for analysis, params in zip(analyses, pooled):
+        pooled_analysis = dict(analysis, plsq=params.tolist())
+        sample_means, sample_concs, pos_neg = elisa_dl.classify_samples(pooled_analysis, antigen, conc_index)
+        results.append({"plsq": params.tolist(), "sample_concs": sample_concs, "pos_neg": pos_neg})
+    rows.append(("pooled fit, nothing shared", time.time() - start, reference_seconds,
+                 compare_calls(reference_calls, results, xs), "curve"))
+
+    cached = [json.dumps(analysis) for analysis in analyses]
+    start = time.time()
+    results = []
+    for text in cached:
+        analysis = json.loads(text)
+        sample_means, sample_concs, pos_neg = elisa_dl.classify_samples(analysis, antigen, conc_index)
+        results.append({"plsq": analysis["plsq"], "sample_concs": sample_concs, "pos_neg": pos_neg})
+    rows.append(("cached analysis (reclassify)", time.time() - start, reference_seconds,
+                 compare_calls(reference_calls, results), "params"))
+    return rows
+
+
+def print_rows(title, rows):
+    """prints a table of engine timings and comparisons. Returns False if any engine disagrees and the number
+    of engines that were not checked"""
+    print(title)
+    print("%-30s %9s %9s %8s  %s" % ("engine", "seconds", "reference", "speedup", "result"))
+    agree = True
+    skipped = 0
+    for name, seconds, reference_seconds, comparison, compared in rows:
+        if isinstance(comparison, str):
+            skipped += 1
+            print("%-30s %9s %9s %8s  SKIP %s" % (name, "-", "-", "-", comparison))
+            continue
+        if isinstance(comparison, tuple):
+            param_difference, conc_difference, flag_mismatches, call_mismatches = comparison
+            same = (param_difference <= rtol and conc_difference <= rtol
+                    and flag_mismatches == 0 and call_mismatches == 0)
+            status = "OK  " if same else "DIFF"
+            result = ("%s %.1e, concs %.1e, flags %s, calls %s"
+                      % (compared, param_difference, conc_difference, flag_mismatches, call_mismatches))
+        else:
+            same = comparison == 0
+            status = "OK  " if same else "DIFF"
+            result = "%s %s differ" % (comparison, compared)
+        agree = agree and same
+        print("%-30s %9.3f %9.3f %7.1fx  %s %s" % (name, seconds, reference_seconds,
+                                                   reference_seconds / max(seconds, 1e-9), status, result))
+    print("")
+    return agree, skipped
+
+
+def run_verify(n_synthetic, plate_ids, strict=False, std_curve="hero", antigen="s"):
+    """checks the reference against the golden results and every engine on real plates and n_synthetic
+    synthetic plates for both pos-neg-methods. Returns False if an engine differs, or with strict if one
+    was not checked"""
+    real_plates = []
+    for plate_id in plate_ids:
+        ods, sample_dilution = elisa_dl.read_plate(plate_id, {})
+        ignore_wells, flagged_wells = elisa_dl.get_ignore_wells(plate_id, ods, {}, ".")
+        real_plates.append((plate_id, ods, ignore_wells, sample_dilution))
+    plates = [(plate_id, ods, ignore_wells) for plate_id, ods, ignore_wells, sample_dilution in real_plates]
+    plates += [(plate_id, ods, {}) for plate_id, ods in shared_plates.synthetic_plates(n_synthetic)]
+
+    agree, skipped = print_rows("Ingest of %s plates" % len(plate_ids), verify_ingest(plate_ids))
+    for conc_index in ["conc", "index"]:
+        rows = [verify_golden(real_plates, std_curve, antigen, conc_index)]
+        rows += verify_engines(plates, std_curve, antigen, conc_index)
+        table_agree, table_skipped = print_rows("Fit and %s calls of %s plates (%s real, %s synthetic), rtol %s"
+                                                % (conc_index, len(plates), len(plate_ids), n_synthetic, rtol),
+                                                rows)
+        agree = agree and table_agree
+        skipped += table_skipped
+    if not agree:
+        print("Some engines DIFFER from the reference")
+    elif skipped > 0:
+        print("All engines that were checked agree with the reference, %s checks were skipped (SKIP)%s"
+              % (skipped, ", which fails with --strict" if strict else ""))
+    else:
+        print("All engines agree with the reference")
+    return agree and not (strict and skipped > 0)
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if arg != "--strict"]
+    if not run_verify(int(args[0]), args[1:] or ["test"], "--strict" in sys.argv[1:]):
+        sys.exit(1)
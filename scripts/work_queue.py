@@ -0,0 +1,222 @@
+import os
+import sys
+import glob
+import json
+import time
+import socket
+import subprocess
+from outputs import atomic_write
+from plate_plans import reader_extensions
+
+'''
+Work queue for spreading a backlog of plates across several machines that share
+a network drive. Plates are discovered from the plate reader files (.xlsx, .xls,
+.txt or .csv) in the shared directory and claimed with lock files created with
+O_CREAT | O_EXCL, which is atomic on local filesystems and on NFSv3+. A claim
+is a lease: the worker touches the lock file while the plate is processing and
+any lock that has not been touched for lease_seconds is treated as abandoned
+and recovered. The age of a lease is measured on the file server's clock (the
+mtime of a probe file touched next to it), as the clocks of the workers may not
+agree with it. A worker whose lease was recovered by another worker stops its
+run of that plate and leaves the plate to the new owner.
+'''
+
+lease_seconds = 600
+poll_seconds = 30
+
+
+def queue_dirs(queue_dir):
+    """returns the lease, done, failed and log directories of a queue, creating them if needed"""
+    dirs = {}
+    for name in ["leases", "done", "failed", "logs"]:
+        dirs[name] = os.path.join(queue_dir, "queue", name)
+        os.makedirs(dirs[name], exist_ok=True)
+    return dirs
+
+
+def find_plates(queue_dir):
+    """returns sorted plate IDs with a plate reader file in the queue directory"""
+    plate_ids = set()
+    for extension in reader_extensions:
+        for reader_file in glob.glob(os.path.join(queue_dir, "*-preader" + extension)):
+            plate_ids.add(os.path.basename(reader_file)[:-len("-preader" + extension)])
+    return sorted(plate_ids)
+
+
+def pending_plates(queue_dir):
+    """returns plate IDs that are neither done nor failed"""
+    dirs = queue_dirs(queue_dir)
+    finished = set()
+    for state in ["done", "failed"]:
+        for marker in os.listdir(dirs[state]):
+            if marker.endswith(".json"):
+                finished.add(marker[:-len(".json")])
+    return [plate_id for plate_id in find_plates(queue_dir) if plate_id not in finished]
+
+
+def server_time(leases_dir, worker_id):
+    """returns the current time on the clock of the file server holding leases_dir, the mtime of a probe file
+    touched there"""
+    probe_path = os.path.join(leases_dir, ".clock.%s" % worker_id)
+    os.close(os.open(probe_path, os.O_CREAT | os.O_WRONLY))
+    try:
+        os.utime(probe_path)
+        return os.path.getmtime(probe_path)
+    finally:
+        os.remove(probe_path)
+
+
+def break_stale_lease(lease_path, worker_id):
+    """removes a lease that has not been renewed for lease_seconds. Returns True if it was removed"""
+    leases_dir = os.path.dirname(lease_path)
+    try:
+        if server_time(leases_dir, worker_id) - os.path.getmtime(lease_path) < lease_seconds:
+            return False
+        stale_path = "%s.%s.stale" % (lease_path, worker_id)
+        os.rename(lease_path, stale_path)
+    except FileNotFoundError:
+        return False
+    # another worker may have recovered the lease and claimed the plate between our
+    # check and the rename, in which case we have just moved its fresh lease aside
+    if server_time(leases_dir, worker_id) - os.path.getmtime(stale_path) < lease_seconds:
+        try:
+            os.link(stale_path, lease_path)
+        except FileExistsError:
+            pass
+        os.remove(stale_path)
+        return False
+    os.remove(stale_path)
+    return True
+
+
+def is_finished(queue_dir, plate_id):
+    """returns True if a plate has a done or failed marker"""
+    dirs = queue_dirs(queue_dir)
+    return any(os.path.exists(os.path.join(dirs[state], plate_id + ".json")) for state in ["done", "failed"])
+
+
+def claim_plate(queue_dir, plate_id, worker_id):
+    """claims a plate if it has no live lease and is not finished. Returns True if it was claimed"""
+    lease_path = os.path.join(queue_dirs(queue_dir)["leases"], plate_id + ".lease")
+    for attempt in range(2):
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if attempt == 0 and break_stale_lease(lease_path, worker_id):
+                print("Recovered abandoned lease for plate %s" % plate_id)
+                continue
+            return False
+        with os.fdopen(fd, "w") as lease:
+            lease.write("%s %s\n" % (worker_id, time.time()))
+        # a plate can finish between listing and claiming, so check again under the lease
+        if not is_finished(queue_dir, plate_id):
+            return True
+        release_plate(queue_dir, plate_id)
+        return False
+    return False
+
+
+def lease_owner(queue_dir, plate_id):
+    """returns the ID of the worker holding the lease on a plate, None if it has no lease"""
+    lease_path = os.path.join(queue_dirs(queue_dir)["leases"], plate_id + ".lease")
+    try:
+        with open(lease_path) as lease:
+            return lease.read().split(" ")[0]
+    except FileNotFoundError:
+        return None
+
+
+def renew_lease(queue_dir, plate_id, worker_id):
+    """touches the lease file so other workers do not treat it as abandoned. Returns False if the lease has
+    been recovered by another worker"""
+    if lease_owner(queue_dir, plate_id) != worker_id:
+        return False
+    lease_path = os.path.join(queue_dirs(queue_dir)["leases"], plate_id + ".lease")
+    try:
+        os.utime(lease_path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def release_plate(queue_dir, plate_id):
+    """removes the lease on a plate"""
+    lease_path = os.path.join(queue_dirs(queue_dir)["leases"], plate_id + ".lease")
+    try:
+        os.remove(lease_path)
+    except FileNotFoundError:
+        pass
+
+
+def finish_plate(queue_dir, plate_id, state, result):
+    """atomically writes the done/failed marker for a plate and releases its lease"""
+    marker = os.path.join(queue_dirs(queue_dir)[state], plate_id + ".json")
+    atomic_write(marker, json.dumps(result, indent=1))
+    release_plate(queue_dir, plate_id)
+
+
+def process_plate(queue_dir, plate_id, worker_id, script, pipeline_args):
+    """runs the normal elisa_dl.py pipeline on a plate, renewing the lease while it runs. Returns the return
+    code of the run, or None if the lease was recovered by another worker, which then owns the plate"""
+    log_path = os.path.join(queue_dirs(queue_dir)["logs"], "%s.%s.log" % (plate_id, worker_id))
+    start = time.time()
+    with open(log_path, "w") as log:
+        proc = subprocess.Popen([sys.executable, script, plate_id] + pipeline_args,
+                                cwd=queue_dir, stdout=log, stderr=subprocess.STDOUT)
+        while True:
+            try:
+                returncode = proc.wait(timeout=lease_seconds / 4)
+                break
+            except subprocess.TimeoutExpired:
+                if not renew_lease(queue_dir, plate_id, worker_id):
+                    proc.kill()
+                    proc.wait()
+                    return None
+
+    # the lease can also be recovered after the last renewal, while the run was finishing
+    if lease_owner(queue_dir, plate_id) != worker_id:
+        return None
+    result = {"plate_id": plate_id,
+              "worker": worker_id,
+              "args": pipeline_args,
+              "returncode": returncode,
+              "seconds": round(time.time() - start, 3),
+              "log": os.path.relpath(log_path, queue_dir)}
+    if returncode == 0:
+        finish_plate(queue_dir, plate_id, "done", result)
+    else:
+        with open(log_path) as log:
+            result["log_tail"] = log.read()[-2000:]
+        finish_plate(queue_dir, plate_id, "failed", result)
+    return returncode
+
+
+def run_worker(queue_dir, script, pipeline_args):
+    """claims and processes plates from queue_dir until every plate is done or failed"""
+    worker_id = "%s-%s" % (socket.gethostname(), os.getpid())
+    print("Worker %s watching %s" % (worker_id, queue_dir))
+
+    processed = 0
+    while True:
+        # the queue directory is listed once per pass, then each pending plate is tried in turn
+        pending = pending_plates(queue_dir)
+        if len(pending) == 0:
+            break
+        claimed = 0
+        for plate_id in pending:
+            if not claim_plate(queue_dir, plate_id, worker_id):
+                continue
+            claimed += 1
+            print("Processing plate %s" % plate_id)
+            returncode = process_plate(queue_dir, plate_id, worker_id, script, pipeline_args)
+            if returncode is None:
+                print("Lease for plate %s was recovered by another worker, stopped processing it" % plate_id)
+                continue
+            if returncode != 0:
+                print("Plate %s failed, see %s" % (plate_id, os.path.join(queue_dir, "queue", "failed")))
+            processed += 1
+        if claimed == 0:
+            # remaining plates are leased by other workers; wait in case a lease is abandoned
+            time.sleep(poll_seconds)
+
+    print("Worker %s finished, processed %s plates" % (worker_id, processed))